@@ -0,0 +1,123 @@
+"""In-process fake of the Smartotum DHT HTTP and WebSocket API, for benchmarks."""
+
+import asyncio
+import json
+import threading
+from collections import Counter
+from aiohttp import web
+
+
+class FakeDHT:
+    """
+    Serves /get_all, /topic_name/... and /ws from an in-memory topic dict,
+    counting the requests per endpoint. Writes and deletions are broadcast
+    to the WebSocket clients as `Persistent` messages, like the real DHT.
+    The server runs on its own event loop in a background thread, so it
+    does not compete with the loop being measured.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.topics = {}  # topic_name -> {topic_uuid -> topic}
+        self.requests = Counter()  # "METHOD endpoint" -> count
+        self._sockets = set()
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    def put(self, name, uuid, value):
+        self.topics.setdefault(name, {})[uuid] = {"topic_name": name, "topic_uuid": uuid, "value": value}
+
+    def request_count(self) -> int:
+        return sum(self.requests.values())
+
+    def _app(self):
+        app = web.Application()
+        app.router.add_get("/get_all", self._get_all)
+        app.router.add_get("/topic_name/{name}", self._get_topics)
+        app.router.add_get("/topic_name/{name}/topic_uuid/{uuid}", self._get_topic)
+        app.router.add_post("/topic_name/{name}/topic_uuid/{uuid}", self._post_topic)
+        app.router.add_delete("/topic_name/{name}/topic_uuid/{uuid}", self._delete_topic)
+        app.router.add_get("/ws", self._ws)
+        return app
+
+    async def _broadcast(self, name, uuid, value, deleted):
+        message = json.dumps({"Persistent": {
+            "topic_name": name, "topic_uuid": uuid, "value": value, "deleted": deleted
+        }})
+        for ws in list(self._sockets):
+            try:
+                await ws.send_str(message)
+            except Exception:
+                self._sockets.discard(ws)
+
+    async def _get_all(self, request):
+        self.requests["GET /get_all"] += 1
+        return web.json_response([topic for topics in self.topics.values() for topic in topics.values()])
+
+    async def _get_topics(self, request):
+        self.requests["GET /topic_name"] += 1
+        return web.json_response(list(self.topics.get(request.match_info["name"], {}).values()))
+
+    async def _get_topic(self, request):
+        self.requests["GET /topic_name/topic_uuid"] += 1
+        topic = self.topics.get(request.match_info["name"], {}).get(request.match_info["uuid"])
+        return web.json_response(topic)
+
+    async def _post_topic(self, request):
+        self.requests["POST /topic_name/topic_uuid"] += 1
+        name, uuid = request.match_info["name"], request.match_info["uuid"]
+        value = await request.json()
+        self.put(name, uuid, value)
+        await self._broadcast(name, uuid, value, False)
+        return web.Response()
+
+    async def _delete_topic(self, request):
+        self.requests["DELETE /topic_name/topic_uuid"] += 1
+        name, uuid = request.match_info["name"], request.match_info["uuid"]
+        topic = self.topics.get(name, {}).pop(uuid, None)
+        await self._broadcast(name, uuid, (topic or {}).get("value"), True)
+        return web.Response()
+
+    async def _ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self._sockets.add(ws)
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            self._sockets.discard(ws)
+        return ws
+
+    async def _start(self):
+        self._runner = web.AppRunner(self._app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def start(self):
+        """Start the server in a background thread and return its port."""
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="FakeDHT", daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.port
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Stand-in for iptables, iptables-restore and ipset used by the benchmarks.
+Invoked through symlinks named after the real tools; every call is
+appended to $BENCH_FIREWALL_LOG (one line per fork) and the rules are
+kept in the JSON file $BENCH_FIREWALL_STATE instead of the kernel.
+"""
+
+import json
+import os
+import sys
+
+STATE = os.environ.get("BENCH_FIREWALL_STATE", "firewall_state.json")
+LOG = os.environ.get("BENCH_FIREWALL_LOG", "firewall_calls.log")
+BUILTIN = ("INPUT", "FORWARD", "OUTPUT")
+
+# Commands that only read the state: saving it back after them could
+# overwrite a change made meanwhile by a concurrent command
+READ_ONLY = {("iptables", "-S"), ("iptables", "-L"), ("iptables", "-C"), ("ipset", "save")}
+
+
+def load():
+    try:
+        with open(STATE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"chains": {chain: [] for chain in BUILTIN}, "sets": {}}
+
+
+def save(state):
+    with open(STATE, "w") as f:
+        json.dump(state, f)
+
+
+def record(line):
+    with open(LOG, "a") as f:
+        f.write(line + "\n")
+
+
+def iptables(state, args):
+    chains = state["chains"]
+    op = args[0]
+    chain = args[1] if len(args) > 1 else None
+    rule = args[2:]
+
+    if op == "-S":
+        out = [f"-P {c} ACCEPT" for c in BUILTIN] + [f"-N {c}" for c in chains if c not in BUILTIN]
+        for c, rules in chains.items():
+            for r in rules:
+                r = [f"{x}/32" if i and r[i - 1] == "-d" and "/" not in x else x for i, x in enumerate(r)]
+                out.append(" ".join(["-A", c] + r))
+        print("\n".join(out))
+        return True
+    if op == "-L":
+        return chain in chains
+    if op == "-N":
+        if chain in chains:
+            return False
+        chains[chain] = []
+        return True
+    if op == "-X":
+        if chain not in chains or chains[chain]:
+            return False
+        del chains[chain]
+        return True
+    if op == "-F":
+        if chain not in chains:
+            return False
+        chains[chain] = []
+        return True
+    if op == "-C":
+        return rule in chains.get(chain, [])
+    if op == "-A":
+        if chain not in chains:
+            return False
+        chains[chain].append(rule)
+        return True
+    if op == "-I":
+        if chain not in chains:
+            return False
+        chains[chain].insert(int(rule[0]) - 1, rule[1:])
+        return True
+    if op == "-D":
+        if rule not in chains.get(chain, []):
+            return False
+        chains[chain].remove(rule)
+        return True
+    return False
+
+
+def iptables_restore(state, script):
+    chains = state["chains"]
+    for line in script.splitlines():
+        if not line.strip() or line.startswith(("*", "COMMIT", "#")):
+            continue
+        if line.startswith(":"):
+            # Declaring a user chain creates or flushes it
+            chains[line[1:].split()[0]] = []
+            continue
+        if not iptables(state, line.split()):
+            sys.stderr.write(f"iptables-restore: failed at: {line}\n")
+            return False
+    return True
+
+
+def ipset(state, args):
+    sets = state["sets"]
+    exist = "-exist" in args
+    args = [x for x in args if x != "-exist"]
+    op, name = args[0], args[1] if len(args) > 1 else None
+
+    if op == "create":
+        if name in sets:
+            return exist
+        sets[name] = []
+        return True
+    if op == "save":
+        if name not in sets:
+            return False
+        print(f"create {name} hash:ip family inet")
+        for member in sets[name]:
+            print(f"add {name} {member}")
+        return True
+    if op in ("add", "del"):
+        if name not in sets:
+            return False
+        members = sets[name]
+        if (args[2] in members) == (op == "add"):
+            return exist
+        if op == "add":
+            members.append(args[2])
+        else:
+            members.remove(args[2])
+        return True
+    if op == "flush":
+        sets[name] = []
+        return True
+    if op == "destroy":
+        return sets.pop(name, None) is not None
+    return False
+
+
+def main():
+    tool = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+    state = load()
+    record(" ".join([tool] + args))
+
+    if tool == "iptables-restore":
+        ok = iptables_restore(state, sys.stdin.read())
+    elif tool == "ipset" and args[:1] == ["restore"]:
+        ok = all(ipset(state, line.split() + args[1:]) for line in sys.stdin.read().splitlines() if line.strip())
+    elif tool == "ipset":
+        ok = ipset(state, args)
+    else:
+        ok = iptables(state, args)
+
+    if ok and (tool, args[0] if args else None) not in READ_ONLY:
+        save(state)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Benchmark the Privacy Manager against a fake DHT and a firewall shim.
+
+    python bench/run.py [--sizes 10,100,1000,10000] [--cycles 5]
+                        [--backend iptables] [--baseline bench/results/<file>.json]
+
+Each fleet size runs in its own process (the manager keeps module-level
+state) with a fleet of cameras, each targeted by one privacy rule. The
+results are printed and saved to bench/results/ for later comparison.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+SHIM = os.path.join(BENCH_DIR, "firewall_shim.py")
+FIREWALL_TOOLS = ("iptables", "iptables-restore", "ipset")
+
+log = logging.getLogger("Bench")
+
+
+def build_fleet(fake, size, now):
+    """
+    Seed the fake DHT with `size` cameras and one rule per camera: half of
+    the rules are active now, and one camera in five starts with the
+    privacy flag set, as after a crash. Half as many sensors without
+    privacy fields are added as background traffic.
+    """
+    today = now.strftime("%A")
+    active = {"time_start": (now - timedelta(hours=1)).strftime("%H:%M"),
+              "time_end": (now + timedelta(hours=1)).strftime("%H:%M")}
+    later = {"time_start": (now + timedelta(hours=2)).strftime("%H:%M"),
+             "time_end": (now + timedelta(hours=3)).strftime("%H:%M")}
+    if later["time_start"] > later["time_end"] or active["time_start"] > active["time_end"]:
+        # Too close to midnight for same-day windows
+        active = {"time_start": "00:00", "time_end": "23:59"}
+        later = {"time_start": "00:00", "time_end": "00:00"}
+
+    for i in range(size):
+        camera = f"camera-{i:05d}"
+        value = {"name": f"Camera {i}", "ip_address": f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"}
+        if i % 5 == 0:
+            value.update(privacy=True, privacy_until="23:59")
+        fake.put("domo_camera", camera, value)
+
+        window = active if i % 2 == 0 else later
+        fake.put("privacy_rule", f"rule-{i:05d}", {
+            "target_topic": "domo_camera",
+            "target_uuid": camera,
+            "days": [today],
+            "expiration_date": (now + timedelta(days=365)).strftime("%Y/%m/%d"),
+            **window
+        })
+
+    for i in range(size // 2):
+        fake.put("domo_sensor", f"sensor-{i:05d}", {"name": f"Sensor {i}", "temperature": 20.5})
+
+
+class Probe:
+    """Measures wall time, DHT requests and firewall forks of a phase."""
+
+    def __init__(self, fake, firewall_log):
+        self._fake = fake
+        self._firewall_log = firewall_log
+
+    def _forks(self):
+        try:
+            with open(self._firewall_log) as f:
+                return sum(1 for _ in f)
+        except OSError:
+            return 0
+
+    async def measure(self, coro):
+        requests, forks = self._fake.request_count(), self._forks()
+        started = time.perf_counter()
+        await coro
+        return {
+            "seconds": round(time.perf_counter() - started, 6),
+            "http_requests": self._fake.request_count() - requests,
+            "firewall_forks": self._forks() - forks
+        }
+
+
+async def run_fleet(fake, size, cycles, firewall_log):
+    # Imported here: settings are read from the environment set up by worker()
+    import dht_client
+    import manager
+    from firewall_controller import FirewallController
+    from privacy_rule import TZ
+    from topic_store import store
+
+    probe = Probe(fake, firewall_log)
+    result = {"size": size}
+
+    async def cycle():
+        # Writes are buffered: a cycle is done when they reach the DHT
+        await manager.reconcile_all_rules()
+        await store.flush()
+
+    await dht_client.client.start()
+    try:
+        result["startup"] = await probe.measure(asyncio.to_thread(FirewallController.load_state))
+        result["reset"] = await probe.measure(manager.reset_all_privacy_flags())
+        result["first_cycle"] = await probe.measure(cycle())
+
+        runs = [await probe.measure(cycle()) for _ in range(cycles)]
+        seconds = [run["seconds"] for run in runs]
+        result["cycle"] = {
+            "seconds": round(statistics.median(seconds), 6),
+            "max_seconds": max(seconds),
+            "http_requests": max(run["http_requests"] for run in runs),
+            "firewall_forks": max(run["firewall_forks"] for run in runs)
+        }
+        result["active_rules"] = len(manager.active_rules(datetime.now(TZ)))
+        result["blocked_ips"] = len(FirewallController.list_blocked_ips())
+        result["http_by_endpoint"] = dict(fake.requests)
+    finally:
+        await store.close()
+        await dht_client.client.close()
+        await asyncio.to_thread(FirewallController.teardown)
+    return result
+
+
+def worker(size, cycles):
+    """Run one fleet size and print its result as JSON on stdout."""
+    sys.path.insert(0, REPO_DIR)
+    from fake_dht import FakeDHT
+
+    fake = FakeDHT()
+    port = fake.start()
+    os.environ["DHT_HOST"] = fake.host
+    os.environ["DHT_PORT"] = str(port)
+    os.environ["JOURNAL_PATH"] = ""
+
+    from privacy_rule import TZ
+    build_fleet(fake, size, datetime.now(TZ))
+    try:
+        result = asyncio.run(run_fleet(fake, size, cycles, os.environ["BENCH_FIREWALL_LOG"]))
+    finally:
+        fake.stop()
+    print(json.dumps(result))
+
+
+def run_worker(size, cycles, backend, workdir):
+    bin_dir = os.path.join(workdir, "bin")
+    env = dict(
+        os.environ,
+        PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""),
+        FIREWALL_BACKEND=backend,
+        BENCH_FIREWALL_STATE=os.path.join(workdir, f"firewall_{size}.json"),
+        BENCH_FIREWALL_LOG=os.path.join(workdir, f"firewall_{size}.log")
+    )
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", str(size), "--cycles", str(cycles)],
+        env=env, stdout=subprocess.PIPE, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Benchmark for {size} cameras failed with exit code {proc.returncode}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+PHASES = ("startup", "reset", "first_cycle", "cycle")
+
+
+def print_report(report, baseline=None):
+    previous = {fleet["size"]: fleet for fleet in (baseline or {}).get("fleets", [])}
+
+    print(f"{'size':>6} {'phase':<12} {'seconds':>10} {'http':>7} {'forks':>6}  vs baseline")
+    for fleet in report["fleets"]:
+        for phase in PHASES:
+            m = fleet[phase]
+            delta = ""
+            before = previous.get(fleet["size"], {}).get(phase)
+            if before:
+                if before["seconds"]:
+                    delta = f"{(m['seconds'] / before['seconds'] - 1) * 100:+.1f}% time"
+                delta += f", http {m['http_requests'] - before['http_requests']:+d}"
+                delta += f", forks {m['firewall_forks'] - before['firewall_forks']:+d}"
+            print(f"{fleet['size']:>6} {phase:<12} {m['seconds']:>10.4f} {m['http_requests']:>7} "
+                  f"{m['firewall_forks']:>6}  {delta}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10,100,1000,10000",
+                        help="comma-separated fleet sizes (cameras and rules)")
+    parser.add_argument("--cycles", type=int, default=5, help="steady-state cycles measured per size")
+    parser.add_argument("--backend", default="iptables", choices=("iptables", "ipset"))
+    parser.add_argument("--baseline", help="previous result file to compare with")
+    parser.add_argument("--output", default=RESULTS_DIR, help="directory for the result file")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        logging.basicConfig(level=logging.WARNING, format="%(name)s: %(message)s", stream=sys.stderr)
+        worker(args.worker, args.cycles)
+        return
+
+    report = {
+        "revision": git_revision(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "backend": args.backend,
+        "cycles": args.cycles,
+        "fleets": []
+    }
+
+    with tempfile.TemporaryDirectory(prefix="privacy-bench-") as workdir:
+        os.mkdir(os.path.join(workdir, "bin"))
+        for tool in FIREWALL_TOOLS:
+            os.symlink(SHIM, os.path.join(workdir, "bin", tool))
+
+        for size in (int(s) for s in args.sizes.split(",")):
+            print(f"Running fleet of {size} cameras...", file=sys.stderr)
+            report["fleets"].append(run_worker(size, args.cycles, args.backend, workdir))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f"{datetime.now():%Y%m%d-%H%M%S}-{report['revision']}-{args.backend}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Check sharded mode with several manager processes against the fake DHT.
+
+    python bench/sharded_run.py [--instances 3] [--size 60]
+
+Starts `--instances` copies of main.py in sharded mode, each on its own
+fake gateway with its own firewall shim state, over a fleet of cameras
+spread across the gateways. It checks that every camera ends up with the
+privacy flag of its rules and is blocked only on its own gateway, then
+kills one instance and checks that a rule added for one of its cameras
+is enforced by the survivors once the lease has expired.
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from fake_dht import FakeDHT
+from run import FIREWALL_TOOLS, SHIM, build_fleet
+
+LEASE_TTL = 3
+LEASE_RENEW = 1
+
+
+def gateway(i) -> str:
+    return f"gw-{i}"
+
+
+def instance(i) -> str:
+    return f"manager-{i}"
+
+
+def get_all(port) -> dict:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/get_all") as resp:
+        topics = json.load(resp)
+    return {(topic["topic_name"], topic["topic_uuid"]): topic.get("value") or {} for topic in topics}
+
+
+def post_topic(port, name, uuid, value):
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/topic_name/{name}/topic_uuid/{uuid}",
+        data=json.dumps(value).encode(), headers={"Content-Type": "application/json"}, method="POST"
+    )
+    urllib.request.urlopen(request).close()
+
+
+def blocked_ips(state_path) -> set:
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    return {rule[1] for rule in state["chains"].get("PRIVACY_CAM", []) if rule[:1] == ["-d"]}
+
+
+def expected_state(topics, now):
+    """Return {camera uuid: privacy} as implied by the rules in the DHT."""
+    from privacy_rule import compile_rule
+
+    expected = {uuid: False for (name, uuid) in topics if name == "domo_camera"}
+    for (name, uuid), value in topics.items():
+        if name == "privacy_rule" and value.get("target_uuid") in expected:
+            if compile_rule(uuid, value).is_active(now):
+                expected[value["target_uuid"]] = True
+    return expected
+
+
+def check(port, states, live, now):
+    """Return a list of mismatches between the DHT, the firewalls and the rules."""
+    topics = get_all(port)
+    problems = []
+
+    for uuid, privacy in expected_state(topics, now).items():
+        camera = topics[("domo_camera", uuid)]
+        if camera.get("privacy", False) != privacy:
+            problems.append(f"{uuid}: privacy {camera.get('privacy', False)}, expected {privacy}")
+
+        for i in live:
+            blocked = camera["ip_address"] in blocked_ips(states[i])
+            should_block = privacy and camera["gateway_id"] == gateway(i)
+            if blocked != should_block:
+                problems.append(f"{uuid}: {'blocked' if blocked else 'not blocked'} on {gateway(i)}")
+
+    leases = {uuid for (name, uuid), value in topics.items()
+              if name == "privacy_manager_lease" and value.get("expires_at", 0) > time.time()}
+    if leases != {instance(i) for i in live}:
+        problems.append(f"live leases {sorted(leases)}")
+    return problems
+
+
+def wait_until_consistent(port, states, live, timeout):
+    from privacy_rule import TZ
+
+    started = time.monotonic()
+    while True:
+        problems = check(port, states, live, datetime.now(TZ))
+        elapsed = time.monotonic() - started
+        if not problems or elapsed > timeout:
+            return problems, elapsed
+        time.sleep(0.5)
+
+
+def start_instance(i, port, workdir):
+    env = dict(
+        os.environ,
+        PATH=os.path.join(workdir, "bin") + os.pathsep + os.environ.get("PATH", ""),
+        DHT_HOST="127.0.0.1",
+        DHT_PORT=str(port),
+        SHARDING="1",
+        INSTANCE_ID=instance(i),
+        GATEWAY_ID=gateway(i),
+        SHARD_LEASE_TTL=str(LEASE_TTL),
+        SHARD_LEASE_RENEW=str(LEASE_RENEW),
+        JOURNAL_PATH=os.path.join(workdir, f"journal_{i}.db"),
+        METRICS_PORT="0",
+        BENCH_FIREWALL_STATE=os.path.join(workdir, f"firewall_{i}.json"),
+        BENCH_FIREWALL_LOG=os.path.join(workdir, f"firewall_{i}.log")
+    )
+    log_file = open(os.path.join(workdir, f"{instance(i)}.log"), "w")
+    return subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "main.py")], env=env,
+                            stdout=log_file, stderr=subprocess.STDOUT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--instances", type=int, default=3)
+    parser.add_argument("--size", type=int, default=60, help="number of cameras and rules")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds allowed to converge")
+    args = parser.parse_args()
+
+    from privacy_rule import TZ
+    from sharding import HashRing
+
+    fake = FakeDHT()
+    port = fake.start()
+    build_fleet(fake, args.size, datetime.now(TZ))
+    cameras = sorted(fake.topics["domo_camera"])
+    for n, uuid in enumerate(cameras):
+        fake.topics["domo_camera"][uuid]["value"]["gateway_id"] = gateway(n % args.instances)
+
+    failed = False
+    processes = {}
+    with tempfile.TemporaryDirectory(prefix="privacy-shards-") as workdir:
+        os.mkdir(os.path.join(workdir, "bin"))
+        for tool in FIREWALL_TOOLS:
+            os.symlink(SHIM, os.path.join(workdir, "bin", tool))
+        states = {i: os.path.join(workdir, f"firewall_{i}.json") for i in range(args.instances)}
+
+        try:
+            for i in range(args.instances):
+                processes[i] = start_instance(i, port, workdir)
+
+            live = set(processes)
+            problems, elapsed = wait_until_consistent(port, states, live, args.timeout)
+            print(f"{len(live)} instances: "
+                  + (f"consistent after {elapsed:.1f}s" if not problems else f"{len(problems)} problem(s)"))
+            failed = bool(problems)
+
+            # Kill an instance and add a rule for a camera it owned but whose gateway survives
+            ring = HashRing([instance(i) for i in live])
+            victim = 0
+            processes[victim].send_signal(signal.SIGKILL)
+            processes[victim].wait()
+            live.discard(victim)
+
+            topics = get_all(port)
+            now = datetime.now(TZ)
+            active = expected_state(topics, now)
+            camera = next(uuid for n, uuid in enumerate(cameras)
+                          if ring.owner(uuid) == instance(victim)
+                          and n % args.instances != victim and not active[uuid])
+            rule = dict(next(value for (name, _), value in topics.items()
+                             if name == "privacy_rule" and active.get(value["target_uuid"])))
+            rule["target_uuid"] = camera
+            post_topic(port, "privacy_rule", "rule-takeover", rule)
+
+            takeover, elapsed = wait_until_consistent(port, states, live, args.timeout + LEASE_TTL)
+            problems += takeover
+            print(f"{instance(victim)} killed, rule added for {camera}: "
+                  + (f"consistent after {elapsed:.1f}s" if not takeover else f"{len(takeover)} problem(s)"))
+            failed = failed or bool(problems)
+            for problem in problems[:20]:
+                print(f"  {problem}")
+        finally:
+            for process in processes.values():
+                if process.poll() is None:
+                    process.send_signal(signal.SIGINT)
+            for process in processes.values():
+                try:
+                    process.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            if failed:
+                for i in processes:
+                    with open(os.path.join(workdir, f"{instance(i)}.log")) as f:
+                        print(f"--- {instance(i)} (last lines)\n" + "".join(f.readlines()[-15:]))
+            fake.stop()
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
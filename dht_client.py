@@ -1,42 +1,216 @@
+import asyncio
 import aiohttp
+import json
 import logging
-from settings import DHT_HOST, DHT_PORT
+import re
+import time
+from metrics import DHT_REQUEST_DURATION, DHT_REQUEST_ERRORS
+from settings import (
+    DHT_HOST, DHT_PORT, DHT_POOL_LIMIT, DHT_TIMEOUT,
+    DHT_CONNECT_TIMEOUT, DHT_RETRIES, DHT_RETRY_BACKOFF
+)
 
 log = logging.getLogger("DHTClient")
 
 BASE_URL = f"http://{DHT_HOST}:{DHT_PORT}"
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_TOPIC_ENDPOINT = "/topic_name/{name}/topic_uuid/{uuid}"
+
+# Bytes that matter to the JSON structure
+_JSON_SPECIAL = re.compile(rb'["\\{}\[\]]')
+
+
+class _ArrayItemSplitter:
+    """
+    Split a top-level JSON array fed in chunks into the raw bytes of its
+    object items, without decoding them. Only quotes, backslashes and
+    brackets are visited, so string contents are skipped quickly.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0  # next byte of _buf to scan
+        self._depth = 0
+        self._in_string = False
+        self._skip = -1  # position of an escaped byte inside a string
+        self._start = None  # start of the item being read
+
+    def feed(self, chunk) -> list[bytes]:
+        self._buf += chunk
+        items = []
+
+        for match in _JSON_SPECIAL.finditer(self._buf, self._pos):
+            i = match.start()
+            c = self._buf[i]
+            if self._in_string:
+                if i == self._skip:
+                    continue
+                if c == 0x5C:  # backslash
+                    self._skip = i + 1
+                elif c == 0x22:  # quote
+                    self._in_string = False
+            elif c == 0x22:
+                self._in_string = True
+            elif c in (0x7B, 0x5B):  # { [
+                self._depth += 1
+                if self._depth == 2:
+                    self._start = i
+            else:  # } ]
+                self._depth -= 1
+                if self._depth == 1 and self._start is not None:
+                    items.append(bytes(self._buf[self._start:i + 1]))
+                    self._start = None
+
+        # Drop the bytes already consumed
+        keep = self._start if self._start is not None else len(self._buf)
+        del self._buf[:keep]
+        self._skip -= keep
+        self._pos = len(self._buf)
+        if self._start is not None:
+            self._start = 0
+        return items
+
+
+class DHTClient:
+    """
+    Long-lived HTTP client for the DHT.
+    Owns a single keep-alive connection pool shared by every request,
+    so connections are reused across rule checks instead of being
+    opened and closed for each call.
+    """
+
+    def __init__(self, base_url=BASE_URL, limit_per_host=DHT_POOL_LIMIT,
+                 timeout=DHT_TIMEOUT, connect_timeout=DHT_CONNECT_TIMEOUT,
+                 retries=DHT_RETRIES, retry_backoff=DHT_RETRY_BACKOFF):
+        self._base_url = base_url
+        self._limit_per_host = limit_per_host
+        self._timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self._retries = retries
+        self._retry_backoff = retry_backoff
+        self._session = None
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self._limit_per_host,
+                keepalive_timeout=60
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self._timeout
+            )
+            log.debug(f"Opened DHT connection pool ({self._limit_per_host} per host)")
+        return self
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            log.debug("Closed DHT connection pool")
+        self._session = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _request(self, method, path, endpoint=None, json=None, read_json=False):
+        """
+        Perform a request on the shared session, retrying on connection
+        errors and timeouts. HTTP error statuses are not retried.
+        `endpoint` is the path template used to label the metrics.
+        """
+        await self.start()
+        url = f"{self._base_url}{path}"
+        labels = {"method": method, "endpoint": endpoint or path}
+
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                async with self._session.request(method, url, json=json) as resp:
+                    log.debug(f"{method} {url}: status {resp.status}")
+                    if read_json:
+                        return await resp.json()
+                    resp.raise_for_status()
+                    return None
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                DHT_REQUEST_ERRORS.inc(**labels)
+                if attempt >= self._retries:
+                    raise
+                delay = self._retry_backoff * (2 ** attempt)
+                attempt += 1
+                log.debug(f"{method} {url} failed ({e!r}), retry {attempt}/{self._retries} in {delay}s")
+                await asyncio.sleep(delay)
+            except Exception:
+                DHT_REQUEST_ERRORS.inc(**labels)
+                raise
+            finally:
+                DHT_REQUEST_DURATION.observe(time.perf_counter() - started, **labels)
+
+    async def fetch_all_topics(self):
+        return await self._request("GET", "/get_all", read_json=True)
+
+    async def stream_all_topics(self, contains=None):
+        """
+        Iterate over /get_all while it downloads, decoding one topic at a
+        time. If `contains` is given, topics whose raw JSON does not include
+        those bytes are skipped without being decoded.
+        """
+        await self.start()
+        url = f"{self._base_url}/get_all"
+        splitter = _ArrayItemSplitter()
+
+        labels = {"method": "GET", "endpoint": "/get_all (stream)"}
+        started = time.perf_counter()
+        try:
+            async with self._session.get(url) as resp:
+                log.debug(f"GET {url}: status {resp.status} (streaming)")
+                resp.raise_for_status()
+                async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    for raw in splitter.feed(chunk):
+                        if contains is None or contains in raw:
+                            yield json.loads(raw)
+        except Exception:
+            DHT_REQUEST_ERRORS.inc(**labels)
+            raise
+        finally:
+            DHT_REQUEST_DURATION.observe(time.perf_counter() - started, **labels)
+
+    async def fetch_topics(self, name):
+        return await self._request("GET", f"/topic_name/{name}", "/topic_name/{name}", read_json=True)
+
+    async def fetch_topic(self, name, uuid):
+        return await self._request("GET", f"/topic_name/{name}/topic_uuid/{uuid}", _TOPIC_ENDPOINT, read_json=True)
+
+    async def update_topic(self, name, uuid, payload):
+        await self._request("POST", f"/topic_name/{name}/topic_uuid/{uuid}", _TOPIC_ENDPOINT, json=payload)
+        log.debug(f"Updated topic {name}:{uuid} with payload {payload}")
+
+    async def delete_topic(self, name, uuid):
+        await self._request("DELETE", f"/topic_name/{name}/topic_uuid/{uuid}", _TOPIC_ENDPOINT)
+
+
+# Shared client, started and closed by main.py
+client = DHTClient()
+
+
 async def fetch_all_topics():
-    url = f"{BASE_URL}/get_all"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            log.debug(f"GET {url}: status {resp.status}")
-            return await resp.json()
+    return await client.fetch_all_topics()
+
+def stream_all_topics(contains=None):
+    return client.stream_all_topics(contains)
 
 async def fetch_topics(name):
-    url = f"{BASE_URL}/topic_name/{name}"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            log.debug(f"GET {url}: status {resp.status}")
-            return await resp.json()
+    return await client.fetch_topics(name)
 
 async def fetch_topic(name, uuid):
-    url = f"{BASE_URL}/topic_name/{name}/topic_uuid/{uuid}"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            log.debug(f"GET {url}: status {resp.status}")
-            return await resp.json()
+    return await client.fetch_topic(name, uuid)
 
 async def update_topic(name, uuid, payload):
-    url = f"{BASE_URL}/topic_name/{name}/topic_uuid/{uuid}"
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload) as resp:
-            log.debug(f"POST {url}: updated topic {name}:{uuid} with payload {payload}")
-            resp.raise_for_status()
+    await client.update_topic(name, uuid, payload)
 
 async def delete_topic(name, uuid):
-    url = f"{BASE_URL}/topic_name/{name}/topic_uuid/{uuid}"
-    async with aiohttp.ClientSession() as session:
-        async with session.delete(url) as resp:
-            log.debug(f"DELETE {url}: status {resp.status}")
-            resp.raise_for_status()
+    await client.delete_topic(name, uuid)
@@ -0,0 +1,46 @@
+import logging
+from datetime import datetime, timedelta, time
+from privacy_rule import TZ
+
+log = logging.getLogger("ExpiryIndex")
+
+
+def next_midnight(now):
+    """Return the next local midnight (Europe/Rome) after `now`."""
+    return datetime.combine(now.date() + timedelta(days=1), time(0), tzinfo=TZ)
+
+
+class ExpiryIndex:
+    """
+    Index of the privacy rules by expiration date.
+    A rule stays valid through its expiration date and expires at the
+    following local midnight, so the expired rules are looked up once per
+    day instead of being checked on every evaluation.
+    """
+
+    def __init__(self):
+        self._by_date = {}  # expiration date ordinal -> set of rule uuids
+        self._dates = {}  # rule uuid -> expiration date ordinal
+
+    def __len__(self):
+        return len(self._dates)
+
+    def add(self, compiled):
+        """Index a CompiledRule, replacing any previous entry for its uuid."""
+        self.remove(compiled.uuid)
+        self._dates[compiled.uuid] = compiled.expiry_ordinal
+        self._by_date.setdefault(compiled.expiry_ordinal, set()).add(compiled.uuid)
+
+    def remove(self, uuid):
+        ordinal = self._dates.pop(uuid, None)
+        if ordinal is None:
+            return
+        uuids = self._by_date[ordinal]
+        uuids.discard(uuid)
+        if not uuids:
+            del self._by_date[ordinal]
+
+    def expired(self, now) -> list:
+        """Return the uuids of the rules expired at `now`."""
+        today = now.toordinal()
+        return [uuid for ordinal, uuids in self._by_date.items() if ordinal < today for uuid in uuids]
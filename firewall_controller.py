@@ -1,22 +1,90 @@
+import os
 import subprocess
 import logging
+import re
+import threading
+import time
+from settings import FIREWALL_BACKEND
+from metrics import FIREWALL_COMMANDS, FIREWALL_COMMAND_DURATION, FIREWALL_TIMEOUTS, BLOCKED_CAMERAS
 
 log = logging.getLogger("FirewallController")
 CHAIN = "PRIVACY_CAM"
+HOOK_CHAINS = ("FORWARD", "OUTPUT")
+IPSET_NAME = "privacy_cam"
 
 def host_iptables_cmd(*args) -> list[str]:
     return ["iptables"] + list(args)
 
-class FirewallController:
+def host_iptables_restore_cmd(*args) -> list[str]:
+    return ["iptables-restore"] + list(args)
+
+def host_ipset_cmd(*args) -> list[str]:
+    return ["ipset"] + list(args)
+
+
+def _run(cmd, **kwargs):
+    """subprocess.run() recording the command count, duration and timeouts."""
+    tool = os.path.basename(cmd[0])
+    started = time.perf_counter()
+    try:
+        result = subprocess.run(cmd, **kwargs)
+    except subprocess.TimeoutExpired:
+        FIREWALL_TIMEOUTS.inc(tool=tool)
+        FIREWALL_COMMANDS.inc(tool=tool, result="timeout")
+        raise
+    except Exception:
+        FIREWALL_COMMANDS.inc(tool=tool, result="error")
+        raise
+    finally:
+        FIREWALL_COMMAND_DURATION.observe(time.perf_counter() - started, tool=tool)
+    FIREWALL_COMMANDS.inc(tool=tool, result="ok" if result.returncode == 0 else "failed")
+    return result
+
+
+class FirewallTransaction:
+    """
+    Blocks and unblocks collected during a cycle and applied together by
+    FirewallController.commit(). The last action recorded for an IP wins.
+    """
+
+    def __init__(self):
+        self._actions = {}  # ip -> True to block, False to unblock
+
+    def __len__(self):
+        return len(self._actions)
+
+    def block(self, ip: str):
+        if ip:
+            self._actions[ip] = True
+
+    def unblock(self, ip: str):
+        if ip:
+            self._actions[ip] = False
+
+    def items(self):
+        return self._actions.items()
+
+
+class IptablesFirewallController:
     """
     Manages IP blocking via iptables on the host gateway.
-    Uses a custom chain to isolate privacy rules for the cameras.
+    Uses a custom chain to isolate privacy rules for the cameras,
+    with one DROP rule per blocked IP.
+
+    An in-memory shadow of the chain (blocked IP -> number of DROP rules)
+    is loaded once from the kernel and answers the idempotency checks, so
+    each block/unblock forks only the iptables command that changes state.
+    Batches of changes go through a single `iptables-restore --noflush`.
     """
 
+    _lock = threading.RLock()
+    _chain_ready = False
+    _shadow = None  # dict ip -> rule count, None until loaded
+
     @staticmethod
     def _run_check(cmd) -> bool:
         try:
-            result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=5)
+            result = _run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=5)
             return result.returncode == 0
         except subprocess.TimeoutExpired:
             log.error(f"Timeout executing command: {' '.join(cmd)}")
@@ -28,7 +96,7 @@ class FirewallController:
     @staticmethod
     def _run_command(cmd) -> bool:
         try:
-            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=5, text=True)
+            result = _run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=5, text=True)
             if result.returncode != 0:
                 log.error(f"iptables command failed: {' '.join(cmd)}")
                 log.error(f"stdout: {result.stdout}")
@@ -42,50 +110,208 @@ class FirewallController:
             log.error(f"Exception running iptables: {e}")
             return False
 
-    @classmethod
-    def ensure_chain(cls) -> bool:
-        if not cls._run_check(host_iptables_cmd("-L", CHAIN, "-n")):
-            log.debug(f"Creating chain {CHAIN}")
-            if not cls._run_command(host_iptables_cmd("-N", CHAIN)):
-                log.error(f"Failed to create chain {CHAIN}")
+    @staticmethod
+    def _restore(lines) -> bool:
+        """
+        Apply rule commands to the filter table atomically in a single
+        iptables-restore run, leaving the other rules untouched.
+        """
+        script = "*filter\n" + "\n".join(lines) + "\nCOMMIT\n"
+        cmd = host_iptables_restore_cmd("--noflush")
+        try:
+            result = _run(cmd, input=script, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          timeout=10, text=True)
+            if result.returncode != 0:
+                log.error(f"iptables-restore failed ({len(lines)} line(s))")
+                log.error(f"stderr: {result.stderr}")
                 return False
-            log.debug(f"Chain {CHAIN} created successfully")
+            return True
+        except subprocess.TimeoutExpired:
+            log.error(f"Timeout executing: {' '.join(cmd)}")
+            return False
+        except Exception as e:
+            log.error(f"Exception running iptables-restore: {e}")
+            return False
 
-        if not cls._run_check(host_iptables_cmd("-C", "FORWARD", "-j", CHAIN)):
-            log.debug(f"Attaching {CHAIN} to FORWARD chain")
-            if not cls._run_command(host_iptables_cmd("-I", "FORWARD", "1", "-j", CHAIN)):
-                log.error(f"Failed to attach {CHAIN} to FORWARD")
-                return False
-            log.debug(f"Chain {CHAIN} attached to FORWARD successfully")
+    @staticmethod
+    def _read_rules():
+        """
+        Read the filter table rules with a single `iptables -S`.
+        Returns the rule lines, or None if the table could not be read.
+        """
+        try:
+            result = _run(host_iptables_cmd("-S"), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          timeout=5, text=True)
+        except Exception as e:
+            log.error(f"Error reading iptables rules: {e}")
+            return None
 
-        if not cls._run_check(host_iptables_cmd("-C", "OUTPUT", "-j", CHAIN)):
-            log.debug(f"Attaching {CHAIN} to OUTPUT chain")
-            if not cls._run_command(host_iptables_cmd("-I", "OUTPUT", "1", "-j", CHAIN)):
-                log.error(f"Failed to attach {CHAIN} to OUTPUT")
-                return False
-            log.debug(f"Chain {CHAIN} attached to OUTPUT successfully")
+        if result.returncode != 0:
+            log.error(f"iptables -S failed: {result.stderr}")
+            return None
+        return result.stdout.splitlines()
+
+    @staticmethod
+    def _parse_hooks(rules):
+        exists = f"-N {CHAIN}" in rules
+        attached = [hook for hook in HOOK_CHAINS if f"-A {hook} -j {CHAIN}" in rules]
+        return exists, attached
+
+    @classmethod
+    def _read_chain(cls):
+        """
+        Returns (chain exists, hook chains jumping to it, {ip: rule count}),
+        or None if the table could not be read.
+        """
+        rules = cls._read_rules()
+        if rules is None:
+            return None
+
+        exists, attached = cls._parse_hooks(rules)
+        blocked = {}
+        for line in rules:
+            parts = line.split()
+            if len(parts) == 6 and parts[:3] == ["-A", CHAIN, "-d"] and parts[4:] == ["-j", "DROP"]:
+                ip = re.sub(r"/32$", "", parts[3])
+                blocked[ip] = blocked.get(ip, 0) + 1
+        return exists, attached, blocked
 
+    @staticmethod
+    def _block_cmd(ip) -> list[str]:
+        return host_iptables_cmd("-A", CHAIN, "-d", ip, "-j", "DROP")
+
+    @staticmethod
+    def _unblock_cmd(ip) -> list[str]:
+        return host_iptables_cmd("-D", CHAIN, "-d", ip, "-j", "DROP")
+
+    @classmethod
+    def _apply_batch(cls, blocks, unblocks) -> bool:
+        lines = [f"-A {CHAIN} -d {ip} -j DROP" for ip in blocks]
+        lines += [f"-D {CHAIN} -d {ip} -j DROP" for ip in unblocks]
+        return cls._restore(lines)
+
+    @classmethod
+    def ensure_chain(cls, force=False) -> bool:
+        with cls._lock:
+            if cls._chain_ready and not force:
+                return True
+            state = cls._read_chain()
+            cls._chain_ready = state is not None and cls._create_chain(state)
+            return cls._chain_ready
+
+    @classmethod
+    def _create_chain(cls, state) -> bool:
+        exists, attached, _ = state
+
+        lines = []
+        if not exists:
+            log.debug(f"Creating chain {CHAIN}")
+            lines.append(f":{CHAIN} - [0:0]")
+        for hook in HOOK_CHAINS:
+            if hook not in attached:
+                log.debug(f"Attaching {CHAIN} to {hook} chain")
+                lines.append(f"-I {hook} 1 -j {CHAIN}")
+
+        if not lines:
+            return True
+        if not cls._restore(lines):
+            log.error(f"Failed to create or attach chain {CHAIN}")
+            return False
+        log.debug(f"Chain {CHAIN} ready")
         return True
 
+    @classmethod
+    def load_state(cls) -> list[str]:
+        """
+        Ensure the chain exists and (re)load the shadow from the kernel.
+        Returns the currently blocked IPs.
+        """
+        with cls._lock:
+            state = cls._read_chain()
+            if state is None:
+                return []
+            cls._chain_ready = cls._create_chain(state)
+            cls._shadow = dict(state[2])
+            return list(cls._shadow)
+
+    @classmethod
+    def _ensure_loaded(cls) -> bool:
+        if cls._shadow is None:
+            cls.load_state()
+        return cls._shadow is not None and cls.ensure_chain()
+
+    @classmethod
+    def transaction(cls) -> FirewallTransaction:
+        return FirewallTransaction()
+
+    @classmethod
+    def commit(cls, tx: FirewallTransaction) -> dict[str, bool]:
+        """
+        Apply all the blocks and unblocks of a transaction in a single
+        iptables-restore run. Returns the outcome of each IP.
+        If the batch is rejected, the shadow is reloaded from the kernel
+        and the entries are applied one by one.
+        """
+        if not len(tx):
+            return {}
+
+        with cls._lock:
+            if not cls._ensure_loaded():
+                return {ip: False for ip, _ in tx.items()}
+
+            blocks = []
+            unblocks = []
+            changes = {}
+            for ip, block in tx.items():
+                count = cls._shadow.get(ip, 0)
+                if block and count == 0:
+                    blocks.append(ip)
+                    changes[ip] = 1
+                elif not block and count > 0:
+                    unblocks.extend([ip] * count)
+                    changes[ip] = 0
+
+            results = {ip: True for ip, _ in tx.items()}
+            if not changes:
+                return results
+
+            if cls._apply_batch(blocks, unblocks):
+                for ip, count in changes.items():
+                    if count:
+                        cls._shadow[ip] = count
+                    else:
+                        del cls._shadow[ip]
+                log.debug(f"✓ Applied firewall transaction ({len(changes)} change(s))")
+                return results
+
+            log.warning("Firewall transaction rejected, applying entries one by one")
+            cls.load_state()
+            for ip, block in tx.items():
+                if ip in changes:
+                    results[ip] = cls.block_ip(ip) if block else cls.unblock_ip(ip)
+            return results
+
     @classmethod
     def block_ip(cls, ip: str) -> bool:
         if not ip:
             log.warning("block_ip called with empty IP")
             return False
 
-        if not cls.ensure_chain():
-            return False
+        with cls._lock:
+            if not cls._ensure_loaded():
+                return False
 
-        if cls._run_check(host_iptables_cmd("-C", CHAIN, "-d", ip, "-j", "DROP")):
-            log.debug(f"IP {ip} already blocked")
-            return True
+            if cls._shadow.get(ip, 0) > 0:
+                log.debug(f"IP {ip} already blocked")
+                return True
 
-        if cls._run_command(host_iptables_cmd("-A", CHAIN, "-d", ip, "-j", "DROP")):
-            log.debug(f"✓ Blocked IP {ip}")
-            return True
-        else:
-            log.error(f"✗ Failed to block IP {ip}")
-            return False
+            if cls._run_command(cls._block_cmd(ip)):
+                cls._shadow[ip] = 1
+                log.debug(f"✓ Blocked IP {ip}")
+                return True
+            else:
+                log.error(f"✗ Failed to block IP {ip}")
+                return False
 
     @classmethod
     def unblock_ip(cls, ip: str) -> bool:
@@ -93,30 +319,31 @@ class FirewallController:
             log.warning("unblock_ip called with empty IP")
             return False
 
-        if not cls.ensure_chain():
-            return False
+        with cls._lock:
+            if not cls._ensure_loaded():
+                return False
 
-        removed_any = False
-        max_attempts = 10
-        attempts = 0
+            count = cls._shadow.get(ip, 0)
+            if count == 0:
+                log.debug(f"IP {ip} was not blocked")
+                return True
 
-        while cls._run_check(host_iptables_cmd("-C", CHAIN, "-d", ip, "-j", "DROP")):
-            if attempts >= max_attempts:
-                log.error(f"Max attempts reached removing rule for {ip}")
-                break
-            if cls._run_command(host_iptables_cmd("-D", CHAIN, "-d", ip, "-j", "DROP")):
-                removed_any = True
-                attempts += 1
-            else:
-                log.error(f"Failed to remove rule for {ip} on attempt {attempts}")
-                break
+            removed = 0
+            while removed < count:
+                if not cls._run_command(cls._unblock_cmd(ip)):
+                    log.error(f"Failed to remove rule for {ip} on attempt {removed}")
+                    break
+                removed += 1
 
-        if removed_any:
-            log.debug(f"✓ Unblocked IP {ip} ({attempts} rule(s) removed)")
-        else:
-            log.debug(f"IP {ip} was not blocked")
+            if removed < count:
+                # The kernel disagrees with the shadow: trust the kernel
+                log.warning(f"Firewall shadow out of sync for {ip}, reloading")
+                cls.load_state()
+                return cls._shadow.get(ip, 0) == 0
 
-        return True
+            del cls._shadow[ip]
+            log.debug(f"✓ Unblocked IP {ip} ({removed} rule(s) removed)")
+            return True
 
     @classmethod
     def cleanup_all(cls) -> bool:
@@ -126,44 +353,226 @@ class FirewallController:
 
         log.debug(f"Cleaning up all rules in {CHAIN}")
         if cls._run_command(host_iptables_cmd("-F", CHAIN)):
+            with cls._lock:
+                cls._shadow = {}
             log.debug(f"✓ All rules flushed from {CHAIN}")
             return True
         else:
             log.error(f"✗ Failed to flush {CHAIN}")
             return False
 
+    @classmethod
+    def teardown(cls) -> bool:
+        """
+        Detach, flush and delete the chain in a single iptables-restore run.
+        """
+        with cls._lock:
+            rules = cls._read_rules()
+            if rules is None:
+                return False
+
+            exists, attached = cls._parse_hooks(rules)
+            lines = [f"-D {hook} -j {CHAIN}" for hook in attached]
+            if exists:
+                lines += [f"-F {CHAIN}", f"-X {CHAIN}"]
+
+            if lines and not cls._restore(lines):
+                log.error(f"✗ Failed to remove chain {CHAIN}")
+                return False
+
+            cls._chain_ready = False
+            cls._shadow = None
+            log.debug(f"✓ Chain {CHAIN} removed")
+            return True
+
     @classmethod
     def list_blocked_ips(cls) -> list[str]:
-        if not cls._run_check(host_iptables_cmd("-L", CHAIN, "-n")):
+        state = cls._read_chain()
+        if state is None:
             return []
 
+        blocked_ips = []
+        for ip, count in state[2].items():
+            blocked_ips.extend([ip] * count)
+        return blocked_ips
+
+    @classmethod
+    def is_ip_blocked(cls, ip: str) -> bool:
+        with cls._lock:
+            if not cls._ensure_loaded():
+                return False
+            return cls._shadow.get(ip, 0) > 0
+
+    @classmethod
+    def check_drift(cls) -> bool:
+        """
+        Compare the shadow with the kernel chain and repair differences:
+        blocks missing from the kernel are re-applied, unexpected kernel
+        rules are adopted into the shadow. Returns True if no drift was found.
+        """
+        with cls._lock:
+            if cls._shadow is None:
+                cls.load_state()
+                return True
+
+            state = cls._read_chain()
+            if state is None:
+                return False
+
+            cls._chain_ready = cls._create_chain(state)
+            if not cls._chain_ready:
+                return False
+
+            exists, attached, kernel = state
+            in_sync = exists and all(hook in attached for hook in HOOK_CHAINS)
+            if kernel == cls._shadow:
+                return in_sync
+
+            missing = [ip for ip in cls._shadow if ip not in kernel]
+            unexpected = [ip for ip in kernel if ip not in cls._shadow]
+            log.warning(f"Firewall drift detected: missing {missing}, unexpected {unexpected}")
+
+            cls._shadow = dict(kernel)
+            if missing and cls._apply_batch(missing, []):
+                for ip in missing:
+                    cls._shadow[ip] = 1
+            return False
+
+
+class IpsetFirewallController(IptablesFirewallController):
+    """
+    Set-based backend: the chain holds a single DROP rule matching the
+    destination against an ipset hash:ip set, and cameras are blocked or
+    unblocked by adding or removing set members. Packets are matched with
+    one hash lookup regardless of the number of blocked cameras.
+    """
+
+    _chain_ready = False
+    _shadow = None
+
+    MATCH_RULE = f"-A {CHAIN} -m set --match-set {IPSET_NAME} dst -j DROP"
+
+    @classmethod
+    def _read_members(cls):
         try:
-            result = subprocess.run(
-                host_iptables_cmd("-L", CHAIN, "-n", "--line-numbers"),
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                timeout=5,
-                text=True
-            )
+            result = _run(host_ipset_cmd("save", IPSET_NAME), stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, timeout=5, text=True)
+        except Exception as e:
+            log.error(f"Error reading ipset {IPSET_NAME}: {e}")
+            return None
 
-            if result.returncode != 0:
-                return []
+        if result.returncode != 0:
+            # The set does not exist yet
+            return {}
 
-            blocked_ips = []
-            for line in result.stdout.split("\n"):
-                if "DROP" in line and "0.0.0.0/0" in line:
-                    parts = line.split()
-                    if len(parts) >= 5:
-                        ip = parts[4]
-                        if ip != "0.0.0.0/0":
-                            blocked_ips.append(ip)
-            return blocked_ips
+        members = {}
+        for line in result.stdout.splitlines():
+            parts = line.split()
+            if len(parts) >= 3 and parts[0] == "add" and parts[1] == IPSET_NAME:
+                members[parts[2]] = 1
+        return members
+
+    @classmethod
+    def _read_chain(cls):
+        """
+        The chain counts as existing only if it holds the set match rule.
+        """
+        rules = cls._read_rules()
+        if rules is None:
+            return None
+        members = cls._read_members()
+        if members is None:
+            return None
 
+        exists, attached = cls._parse_hooks(rules)
+        return exists and cls.MATCH_RULE in rules, attached, members
+
+    @classmethod
+    def _create_chain(cls, state) -> bool:
+        if not cls._run_command(host_ipset_cmd("create", IPSET_NAME, "hash:ip", "-exist")):
+            log.error(f"Failed to create ipset {IPSET_NAME}")
+            return False
+
+        exists, attached, _ = state
+        lines = []
+        if not exists:
+            # Declaring the chain also flushes leftover per-IP rules
+            log.debug(f"Creating chain {CHAIN} matching set {IPSET_NAME}")
+            lines += [f":{CHAIN} - [0:0]", cls.MATCH_RULE]
+        for hook in HOOK_CHAINS:
+            if hook not in attached:
+                log.debug(f"Attaching {CHAIN} to {hook} chain")
+                lines.append(f"-I {hook} 1 -j {CHAIN}")
+
+        if not lines:
+            return True
+        if not cls._restore(lines):
+            log.error(f"Failed to create or attach chain {CHAIN}")
+            return False
+        log.debug(f"Chain {CHAIN} ready")
+        return True
+
+    @staticmethod
+    def _block_cmd(ip) -> list[str]:
+        return host_ipset_cmd("add", IPSET_NAME, ip, "-exist")
+
+    @staticmethod
+    def _unblock_cmd(ip) -> list[str]:
+        return host_ipset_cmd("del", IPSET_NAME, ip, "-exist")
+
+    @classmethod
+    def _apply_batch(cls, blocks, unblocks) -> bool:
+        lines = [f"add {IPSET_NAME} {ip}" for ip in blocks]
+        lines += [f"del {IPSET_NAME} {ip}" for ip in unblocks]
+        cmd = host_ipset_cmd("restore", "-exist")
+        try:
+            result = _run(cmd, input="\n".join(lines) + "\n", stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, timeout=10, text=True)
+            if result.returncode != 0:
+                log.error(f"ipset restore failed ({len(lines)} line(s))")
+                log.error(f"stderr: {result.stderr}")
+                return False
+            return True
+        except subprocess.TimeoutExpired:
+            log.error(f"Timeout executing: {' '.join(cmd)}")
+            return False
         except Exception as e:
-            log.error(f"Error listing blocked IPs: {e}")
-            return []
+            log.error(f"Exception running ipset restore: {e}")
+            return False
 
     @classmethod
-    def is_ip_blocked(cls, ip: str) -> bool:
-        return cls._run_check(host_iptables_cmd("-C", CHAIN, "-d", ip, "-j", "DROP"))
+    def cleanup_all(cls) -> bool:
+        log.debug(f"Cleaning up all members of {IPSET_NAME}")
+        if cls._run_command(host_ipset_cmd("flush", IPSET_NAME)):
+            with cls._lock:
+                cls._shadow = {}
+            log.debug(f"✓ All members flushed from {IPSET_NAME}")
+            return True
+        else:
+            log.error(f"✗ Failed to flush {IPSET_NAME}")
+            return False
+
+    @classmethod
+    def teardown(cls) -> bool:
+        with cls._lock:
+            if not super().teardown():
+                return False
+            if not cls._run_command(host_ipset_cmd("destroy", IPSET_NAME)):
+                log.error(f"✗ Failed to destroy ipset {IPSET_NAME}")
+                return False
+            log.debug(f"✓ ipset {IPSET_NAME} destroyed")
+            return True
+
+
+BACKENDS = {
+    "iptables": IptablesFirewallController,
+    "ipset": IpsetFirewallController,
+}
+
+if FIREWALL_BACKEND not in BACKENDS:
+    log.error(f"Unknown firewall backend '{FIREWALL_BACKEND}', using iptables")
+
+# Backend used by the manager, selected with FIREWALL_BACKEND
+FirewallController = BACKENDS.get(FIREWALL_BACKEND, IptablesFirewallController)
 
+BLOCKED_CAMERAS.set_function(lambda: len(FirewallController._shadow or ()))
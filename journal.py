@@ -0,0 +1,105 @@
+import json
+import logging
+import sqlite3
+import time
+from settings import JOURNAL_PATH
+
+log = logging.getLogger("Journal")
+
+
+class EnforcementJournal:
+    """
+    On-disk record of the enforcement currently applied: for each blocked
+    device, the rules blocking it, the firewall entry and when it was
+    applied. After a crash-restart the manager compares it with the
+    current rules instead of unblocking every device.
+    The journal is a no-op until open() is called.
+    """
+
+    def __init__(self, path=JOURNAL_PATH):
+        self._path = path
+        self._db = None
+        self._entries = {}  # (target_topic, target_uuid) -> (rule uuids, blocked ip)
+
+    def open(self):
+        if not self._path or self._db is not None:
+            return self
+        self._db = sqlite3.connect(self._path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS enforcement ("
+            " target_topic TEXT NOT NULL,"
+            " target_uuid TEXT NOT NULL,"
+            " rule_uuids TEXT NOT NULL,"
+            " blocked_ip TEXT,"
+            " applied_at REAL NOT NULL,"
+            " PRIMARY KEY (target_topic, target_uuid))"
+        )
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.commit()
+
+        for topic, uuid, rule_uuids, blocked_ip in self._db.execute(
+            "SELECT target_topic, target_uuid, rule_uuids, blocked_ip FROM enforcement"
+        ):
+            self._entries[(topic, uuid)] = (tuple(json.loads(rule_uuids)), blocked_ip)
+        log.debug(f"Opened journal {self._path} with {len(self._entries)} entries")
+        return self
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @property
+    def initialized(self) -> bool:
+        """True once a cold start has completed with this journal."""
+        if self._db is None:
+            return False
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'initialized'").fetchone()
+        return row is not None
+
+    def mark_initialized(self):
+        if self._db is None:
+            return
+        self._db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('initialized', ?)", (str(time.time()),)
+        )
+        self._db.commit()
+
+    def entries(self) -> dict:
+        return dict(self._entries)
+
+    def record(self, target, rule_uuids, blocked_ip=None):
+        """Record that a device is blocked; unchanged entries are not rewritten."""
+        entry = (tuple(sorted(rule_uuids)), blocked_ip)
+        if self._db is None or self._entries.get(target) == entry:
+            return
+        self._db.execute(
+            "INSERT OR REPLACE INTO enforcement"
+            " (target_topic, target_uuid, rule_uuids, blocked_ip, applied_at)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (target[0], target[1], json.dumps(entry[0]), blocked_ip, time.time())
+        )
+        self._db.commit()
+        self._entries[target] = entry
+
+    def remove(self, target):
+        if self._db is None or target not in self._entries:
+            return
+        self._db.execute(
+            "DELETE FROM enforcement WHERE target_topic = ? AND target_uuid = ?", target
+        )
+        self._db.commit()
+        del self._entries[target]
+
+    def clear(self):
+        if self._db is None:
+            return
+        self._db.execute("DELETE FROM enforcement")
+        self._db.commit()
+        self._entries.clear()
+
+
+# Shared journal, opened and closed by main.py
+journal = EnforcementJournal()
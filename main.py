@@ -1,9 +1,21 @@
 import asyncio
 import logging
-from ws_client import WSClient
-from manager import reset_all_privacy_flags, check_rules_periodically, listen_rule_deletions
+from ws_client import WSClient, CoalescingQueue
+from manager import (
+    restore_enforcement, check_rules_periodically,
+    listen_dht_updates, check_firewall_drift_periodically, expire_rules_periodically,
+    start_sharding, rebalance, sync_gateway_firewall, request_resync
+)
 from firewall_controller import FirewallController
-from asyncio import Queue
+import dht_client
+from topic_store import store
+from journal import journal
+from sharding import shards
+from profiling import profiler
+import metrics
+from settings import (
+    WS_QUEUE_SIZE, WS_OVERFLOW_POLICY, WS_COALESCE_WINDOW, METRICS_HOST, METRICS_PORT
+)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -19,40 +31,67 @@ async def cleanup_on_shutdown():
     Clear all firewall rules upon shutdown.
     """
     log.info("Shutting down, cleaning up cameras firewall rules...")
-    await asyncio.to_thread(FirewallController.cleanup_all)
 
-    # Remove the chain as well
-    await asyncio.to_thread(FirewallController._run_command, 
-                            ["iptables", "-D", "OUTPUT", "-j", "PRIVACY_CAM"])
-    await asyncio.to_thread(FirewallController._run_command,
-                            ["iptables", "-D", "FORWARD", "-j", "PRIVACY_CAM"])
-    await asyncio.to_thread(FirewallController._run_command, 
-                            ["iptables", "-X", "PRIVACY_CAM"])
+    # Detach, flush and remove the chain in a single iptables-restore run
+    await asyncio.to_thread(FirewallController.teardown)
 
     log.info("Cleanup completed")
 
 
 async def main():
-    message_queue = Queue()
-    ws_client = WSClient(message_queue)
+    # Watch the loop for blocking work from the start
+    profiler.install(asyncio.get_running_loop())
+    loop_monitor = asyncio.create_task(profiler.monitor(), name="loop_monitor")
+
+    # A dropped message leaves the replica stale, so it is re-synced
+    message_queue = CoalescingQueue(
+        maxsize=WS_QUEUE_SIZE,
+        window=WS_COALESCE_WINDOW,
+        overflow=WS_OVERFLOW_POLICY,
+        on_overflow=request_resync
+    )
+    ws_client = WSClient(message_queue, on_connect=request_resync, accept=store.accepts)
+    store.on_stale = request_resync
+    metrics.WS_QUEUE_DEPTH.set_function(message_queue.qsize)
 
-    # Initialize the firewall chain at startup
-    await asyncio.to_thread(FirewallController.ensure_chain)
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT)
+
+    # Open the shared DHT connection pool
+    await dht_client.client.start()
+
+    # Initialize the firewall chain and load its current state at startup
+    blocked = await asyncio.to_thread(FirewallController.load_state)
     log.info("Initialized cameras firewall chain")
 
     # Log of currently blocked IPs
-    blocked = await asyncio.to_thread(FirewallController.list_blocked_ips)
     if blocked:
         log.warning(f"Found {len(blocked)} IPs already blocked: {blocked}")
 
-    await reset_all_privacy_flags()
+    # In sharded mode, learn which devices this instance owns before touching any
+    if shards.enabled:
+        await start_sharding()
+
+    # Reset every device on a cold start, or check the journaled ones on a warm restart
+    journal.open()
+    await restore_enforcement()
 
+    # Named tasks, so that slow callbacks can be traced back to them
     tasks = [
-        asyncio.create_task(ws_client.run()),
-        asyncio.create_task(check_rules_periodically()),
-        asyncio.create_task(listen_rule_deletions(ws_client))
+        loop_monitor,
+        asyncio.create_task(ws_client.run(), name="ws_client"),
+        asyncio.create_task(check_rules_periodically(), name="check_rules"),
+        asyncio.create_task(expire_rules_periodically(), name="expiry_sweeper"),
+        asyncio.create_task(listen_dht_updates(ws_client), name="listen_dht_updates"),
+        asyncio.create_task(check_firewall_drift_periodically(), name="firewall_drift")
     ]
+    if shards.enabled:
+        tasks.append(asyncio.create_task(
+            shards.run(on_change=rebalance, on_renew=sync_gateway_firewall), name="shard_lease"
+        ))
 
+    crashed = False
     try:
         await asyncio.gather(*tasks)
     except asyncio.CancelledError:
@@ -62,8 +101,22 @@ async def main():
         for t in tasks:
             t.cancel()
         await asyncio.gather(*tasks, return_exceptions=True)
+    except Exception:
+        crashed = True
+        raise
     finally:
-        await cleanup_on_shutdown()
+        if crashed:
+            # Keep the cameras blocked: the restart checks them against the journal
+            log.warning("Main: Crashed, leaving firewall rules in place")
+        else:
+            await cleanup_on_shutdown()
+        if shards.enabled:
+            await shards.release()
+        await store.close()
+        await dht_client.client.close()
+        journal.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
         log.debug("Main: Shutdown complete")
 
 if __name__ == "__main__":
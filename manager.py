@@ -1,186 +1,680 @@
 import asyncio
 import logging
-from dht_client import fetch_all_topics, fetch_topics, fetch_topic, update_topic, delete_topic
-from privacy_rule import PrivacyRule, PRIVACY_RULE_TOPIC
+import time
+from dht_client import stream_all_topics
+from topic_store import store
+from journal import journal
+from privacy_rule import PrivacyRule, PRIVACY_RULE_TOPIC, forget_rule, current_time
 from firewall_controller import FirewallController
+from scheduler import RuleScheduler
+from rule_index import WeeklyRuleIndex
+from expiry import ExpiryIndex, next_midnight
+from reconciler import diff_device
+from metrics import CYCLE_DURATION, RULES, BLOCKED_DEVICES
+from sharding import shards, LEASE_TOPIC
+from profiling import profiler
+from settings import (
+    RECONCILE_INTERVAL, FIREWALL_DRIFT_INTERVAL, RULE_CONCURRENCY,
+    CYCLE_DEADLINE
+)
 
 log = logging.getLogger("Manager")
 
+CAMERA_TOPIC = "domo_camera"
+
+# Retry delay after a failed scan and minimum sleep between wakeups (seconds)
+RETRY_INTERVAL = 60
+MIN_SLEEP = 0.05
+# Longest sleep of the expiry sweeper, so a wall clock step is noticed (seconds)
+MAX_EXPIRY_SLEEP = 3600
+
+# Rules known from the last full scan and their pending transitions
+_rules = {}
+_rules_by_target = {}  # (target_topic, target_uuid) -> set of rule uuids
+_scheduler = RuleScheduler()
+_wakeup = asyncio.Event()  # wakes check_rules_periodically before its scheduled time
+_resync_requested = False  # the replica missed changes, a full scan is due at once
+_index = WeeklyRuleIndex()
+_expiry = ExpiryIndex()
+_expiry_due = asyncio.Event()  # set when an already expired rule is indexed
+_blocked = set()  # targets blocked by the last reconciliation
+_camera_ips = {}  # camera uuid -> IP blocked for it
+_ip_cameras = {}  # blocked IP -> camera uuids holding it, in case an address is reused
+
+
+def active_rules(now=None) -> list:
+    """
+    Return the known rules active at `now`, looked up in the weekly index
+    instead of evaluating every rule.
+    """
+    now = now or current_time()
+    active = []
+    for uuid in _index.active_at(now):
+        rule = _rules.get(uuid)
+        if rule is not None and not rule.compiled.is_expired(now):
+            active.append(rule)
+    return active
+
+
+def rule_states(now=None) -> dict:
+    """
+    Count the known rules by state, for the metrics, from the weekly and
+    expiry indexes rather than by evaluating every rule.
+    """
+    now = now or current_time()
+    expired = set(_expiry.expired(now))
+    active = sum(1 for uuid in _index.active_at(now) if uuid not in expired)
+    return {
+        ("active",): active,
+        ("inactive",): len(_rules) - active - len(expired),
+        ("expired",): len(expired)
+    }
+
+
+RULES.set_function(rule_states)
+BLOCKED_DEVICES.set_function(lambda: len(_blocked))
+
 
 async def reset_all_privacy_flags():
     """
     On startup, reset all privacy flags and unblock all devices.
     IMPORTANT: This prevents devices from remaining locked after a crash.
+    /get_all is parsed as it streams and only topics with the privacy flag
+    set are kept; cameras are unblocked in one firewall batch and the DHT
+    flags are reset through the write buffer, WRITE_CONCURRENCY at a time.
     """
     log.info("Resetting device privacy flags...")
 
-    topics = await fetch_all_topics()
-    log.debug(f"Fetched {len(topics)} topics for initial privacy reset")
+    topics = []
+    async for topic in stream_all_topics(contains=b'"privacy"'):
+        # In sharded mode the other instances keep their devices
+        if (topic.get("value") or {}).get("privacy", False) and shards.owns(topic["topic_uuid"]):
+            topics.append(topic)
+    log.debug(f"Found {len(topics)} topics to reset")
 
+    # Unblock cameras
+    tx = FirewallController.transaction()
     for topic in topics:
-        value = topic.get("value", {})
-
-        if value.get("privacy", False):
-            value["privacy"] = False
-
-            # Unblock cameras
-            if topic["topic_name"] == "domo_camera":
-                ip = value.get("ip_address")
-                if ip:
-                    success = await asyncio.to_thread(FirewallController.unblock_ip, ip)
-                    if success:
-                        log.debug(f"Unblocked camera {value.get('name', 'unknown')} at {ip}")
-                    else:
-                        log.error(f"Failed to unblock camera at {ip}")
-
-            await update_topic(
-                topic["topic_name"],
-                topic["topic_uuid"],
-                value
-            )
-            log.debug(f"Reset privacy for {topic['topic_name']}:{topic['topic_uuid']}")
+        topic["value"]["privacy"] = False
+        if topic["topic_name"] == CAMERA_TOPIC:
+            _queue_camera_firewall(tx, topic["topic_uuid"], topic["value"])
+    await commit_firewall(tx)
+
+    writes = [store.update(topic["topic_name"], topic["topic_uuid"], topic["value"]) for topic in topics]
+    results = await asyncio.gather(*writes, return_exceptions=True)
+    for topic, result in zip(topics, results):
+        if isinstance(result, Exception):
+            log.error(f"Failed to reset privacy for {topic['topic_name']}:{topic['topic_uuid']}: {result!r}")
 
     log.info("Restore completed")
 
 
-async def check_rules_periodically():
+async def restore_enforcement():
+    """
+    Bring devices back in line with the rules after a (re)start.
+    On the first start with an empty journal every privacy flag is reset;
+    on a warm restart only the devices recorded in the journal are checked
+    against the current rules, so blocked devices stay blocked.
+    """
+    if not journal.initialized:
+        await reset_all_privacy_flags()
+        journal.clear()
+        journal.mark_initialized()
+        return
+
+    entries = journal.entries()
+    log.info(f"Warm restart: checking {len(entries)} journaled devices against the rules")
+    for (target_topic_name, target_uuid), (_, ip_address) in entries.items():
+        if target_topic_name == CAMERA_TOPIC and ip_address:
+            _track_camera(target_uuid, ip_address)
+    await load_rules()
+    try:
+        await reconcile_targets(entries.keys())
+    except RuntimeError as e:
+        # The first full scan retries the devices left behind
+        log.error(f"Warm restart incomplete: {e}")
+    log.info("Restore completed")
+
+
+def _build_rule(rule_json) -> PrivacyRule:
+    # A missing or malformed value is rejected by compile_rule()
+    value = rule_json.get("value")
+    fields = value if isinstance(value, dict) else {}
+    return PrivacyRule(
+        rule_json["topic_uuid"],
+        fields.get("target_topic"),
+        fields.get("target_uuid"),
+        value
+    )
+
+
+async def commit_firewall(tx):
+    """
+    Apply the firewall changes collected during a cycle in one batch.
+    """
+    results = await asyncio.to_thread(FirewallController.commit, tx)
+    for ip, block in tx.items():
+        if not results.get(ip):
+            log.error(f"✗ Failed to {'block' if block else 'unblock'} camera at {ip}")
+    if len(tx):
+        log.debug(f"Firewall transaction committed ({len(tx)} camera(s))")
+    return results
+
+
+def _track_camera(camera_uuid, ip_address):
+    _untrack_camera(camera_uuid)
+    _camera_ips[camera_uuid] = ip_address
+    _ip_cameras.setdefault(ip_address, set()).add(camera_uuid)
+
+
+def _untrack_camera(camera_uuid):
+    """
+    Drop a camera from the IP index. Returns the IP it held if no other
+    camera holds it, i.e. the address can be unblocked, or None.
+    """
+    ip_address = _camera_ips.pop(camera_uuid, None)
+    if ip_address is None:
+        return None
+    cameras = _ip_cameras[ip_address]
+    cameras.discard(camera_uuid)
+    if cameras:
+        return None
+    del _ip_cameras[ip_address]
+    return ip_address
+
+
+def _release_camera(tx, camera_uuid):
+    """Queue the unblock of the IP blocked for a camera, if any."""
+    ip_address = _untrack_camera(camera_uuid)
+    if ip_address is not None:
+        tx.unblock(ip_address)
+
+
+def _queue_camera_firewall(tx, camera_uuid, value):
+    """
+    Queue the firewall entry of a camera matching its privacy flag, if
+    this instance manages it. Returns the camera IP, or None.
+    The block follows the camera: if its IP changed since it was blocked,
+    the old address is unblocked in the same transaction.
+    """
+    ip_address = value.get("ip_address")
+    enforced = bool(ip_address) and shards.enforces_firewall(camera_uuid, value)
+    blocked = enforced and value.get("privacy", False)
+
+    previous = _camera_ips.get(camera_uuid)
+    if previous is not None and (not blocked or previous != ip_address):
+        if blocked:
+            log.info(f"Camera {camera_uuid} moved from {previous} to {ip_address}, moving its block")
+        _release_camera(tx, camera_uuid)
+
+    if not enforced:
+        return None
+    if blocked:
+        tx.block(ip_address)
+        _track_camera(camera_uuid, ip_address)
+    elif ip_address not in _ip_cameras:
+        tx.unblock(ip_address)
+    return ip_address
+
+
+def _target_of(rule):
+    return rule.target_topic, rule.target_uuid
+
+
+def _remember(rule):
+    """Add or replace a rule in the known rules, the index and the scheduler."""
+    previous = _rules.get(rule.uuid)
+    if previous is None or previous.compiled is not rule.compiled:
+        if previous is not None:
+            _unlink(rule.uuid)
+        _rules_by_target.setdefault(_target_of(rule), set()).add(rule.uuid)
+        _index.add(rule.compiled)
+        _expiry.add(rule.compiled)
+        if rule.compiled.is_expired(current_time()):
+            _expiry_due.set()
+        store.watch(rule.target_topic)
+    _rules[rule.uuid] = rule
+
+    wakeup = _scheduler.next_wakeup()
+    _scheduler.schedule(rule)
+    earliest = _scheduler.next_wakeup()
+    if earliest is not None and (wakeup is None or earliest < wakeup):
+        _wakeup.set()
+
+
+def _unlink(uuid):
+    rule = _rules.pop(uuid, None)
+    if rule is not None:
+        target = _target_of(rule)
+        uuids = _rules_by_target.get(target)
+        if uuids is not None:
+            uuids.discard(uuid)
+            if not uuids:
+                del _rules_by_target[target]
+    _scheduler.discard(uuid)
+    _index.remove(uuid)
+    _expiry.remove(uuid)
+
+
+def _forget(uuid):
+    _unlink(uuid)
+    forget_rule(uuid)
+
+
+async def apply_target_rules(target, rules, tx):
+    """
+    Fetch a target device once, combine all its rules into the desired
+    privacy state and write only the fields that actually change.
+    Expired rules count as inactive; they are deleted by expire_rules().
+    DHT writes are queued in the store's write
+    buffer rather than awaited. Camera firewall changes are collected in
+    `tx` and applied by commit_firewall() at the end of the cycle, and the
+    resulting state is recorded in the enforcement journal.
+    """
+    target_topic_name, target_uuid = target
+    target_topic = await store.topic(target_topic_name, target_uuid)
+
+    if not target_topic:
+        log.warning(f"Target topic not found: {target_topic_name}:{target_uuid}")
+        if target_topic_name == CAMERA_TOPIC:
+            # Deleted camera: only the index still knows which IP to unblock
+            _release_camera(tx, target_uuid)
+        # A deleted device is no longer blocked
+        journal.remove(target)
+        _blocked.discard(target)
+        return
+
+    now = current_time()
+    value = target_topic["value"]
+    changes = diff_device(value, rules, now)
+    value.update(changes)
+
+    # Keep the camera firewall in line with the desired state;
+    # entries that already match cost nothing at commit time
+    ip_address = None
+    if target_topic["topic_name"] == CAMERA_TOPIC:
+        ip_address = _queue_camera_firewall(tx, target_uuid, value)
+
+    if changes:
+        store.update(target_topic_name, target_uuid, value)
+
+        name = value.get("name", "a device")
+        if "privacy" not in changes:
+            log.info(f"Privacy extended: {name} is blocked until {value['privacy_until']}")
+        elif changes["privacy"]:
+            log.info(f"Privacy rule activated: {name} is now blocked")
+        else:
+            log.info(f"Privacy period ended: {name} is now available again")
+
+    if value.get("privacy", False):
+        active = [rule.uuid for rule in rules if rule.compiled.is_active(now)]
+        journal.record(target, active, ip_address)
+        _blocked.add(target)
+    else:
+        journal.remove(target)
+        _blocked.discard(target)
+
+
+async def apply_rules(rules, tx, targets=()):
+    """
+    Reconcile rules grouped by target device; `targets` lists devices to
+    reconcile even if no rule targets them any more. Targets are processed
+    concurrently, at most RULE_CONCURRENCY at a time, within CYCLE_DEADLINE
+    seconds; a slow or failing device does not hold back the others.
+    Raises RuntimeError once all targets are done if any of them failed.
+    """
+    groups = {target: [] for target in targets}
+    for rule in rules:
+        groups.setdefault(_target_of(rule), []).append(rule)
+
+    if shards.enabled:
+        for target in [target for target in groups if not shards.owns(target[1])]:
+            # Owned by another instance, possibly since a rebalance
+            del groups[target]
+            journal.remove(target)
+            _blocked.discard(target)
+    if not groups:
+        return
+
+    semaphore = asyncio.Semaphore(RULE_CONCURRENCY)
+
+    async def run_group(target, group):
+        async with semaphore:
+            await apply_target_rules(target, group, tx)
+
+    tasks = {
+        asyncio.create_task(run_group(target, group)): target
+        for target, group in groups.items()
+    }
+    done, pending = await asyncio.wait(tasks, timeout=CYCLE_DEADLINE)
+
+    for task in pending:
+        task.cancel()
+        log.warning(f"Deadline exceeded for target {tasks[task][0]}:{tasks[task][1]}")
+    if pending:
+        await asyncio.wait(pending)
+
+    failed = len(pending)
+    for task in done:
+        if task.exception() is not None:
+            failed += 1
+            target_topic_name, target_uuid = tasks[task]
+            log.error(f"Error applying rules to {target_topic_name}:{target_uuid}: {task.exception()!r}")
+
+    if failed:
+        raise RuntimeError(f"{failed} of {len(groups)} targets not updated")
+
+
+async def load_rules() -> dict:
+    """
+    Read every privacy rule from the topic store, refresh the index and
+    reschedule their next transitions. Rules no longer in the DHT are
+    forgotten.
+    """
+    rules_data = await store.topics(PRIVACY_RULE_TOPIC)
+
+    rules = {}
+    for rule_json in rules_data:
+        rule = _build_rule(rule_json)
+        if not rule.rejected:
+            rules[rule.uuid] = rule
+
+    for uuid in _rules.keys() - rules.keys():
+        _forget(uuid)
+
+    for rule in rules.values():
+        _remember(rule)
+    return rules
+
+
+async def reconcile_all_rules():
+    """
+    Full scan: reload every privacy rule and reconcile all their devices,
+    as well as the devices currently blocked.
+    """
+    rules = await load_rules()
+
+    tx = FirewallController.transaction()
+    try:
+        if shards.enabled:
+            await mirror_cameras(tx)
+        # Blocked devices whose rules were all deleted meanwhile are released too
+        await apply_rules(rules.values(), tx, set(_blocked))
+    finally:
+        await commit_firewall(tx)
+
+    # Every camera has been visited, so the index is complete
+    await remove_orphaned_blocks()
+
+
+async def remove_orphaned_blocks():
+    """
+    Unblock the IPs left in the firewall chain that no camera holds, e.g.
+    the old address of a camera whose IP changed while we were down.
+    """
+    blocked = await asyncio.to_thread(FirewallController.list_blocked_ips)
+    orphans = set(blocked) - _ip_cameras.keys()
+    if not orphans:
+        return
+
+    log.info(f"Removing {len(orphans)} orphaned firewall block(s)")
+    tx = FirewallController.transaction()
+    for ip_address in orphans:
+        tx.unblock(ip_address)
+    await commit_firewall(tx)
+
+
+async def mirror_cameras(tx, cameras=None):
     """
-    Periodically check the privacy rules and apply blocks/unblocks to the devices.
+    Sharded mode: align the firewall of the cameras of this gateway owned
+    by other instances with the privacy flag those instances wrote.
+    """
+    if cameras is None:
+        cameras = await store.topics(CAMERA_TOPIC)
+    for camera in cameras:
+        if not shards.owns(camera["topic_uuid"]):
+            _queue_camera_firewall(tx, camera["topic_uuid"], camera.get("value") or {})
+
+
+async def sync_gateway_firewall():
+    """
+    Sharded mode: mirror the cameras owned by other instances, catching
+    up on changes missed while the WebSocket was down.
+    """
+    tx = FirewallController.transaction()
+    try:
+        await mirror_cameras(tx)
+    finally:
+        await commit_firewall(tx)
+
+
+async def start_sharding():
+    """Join the shard members; cameras owned elsewhere are mirrored, so they are watched."""
+    store.watch(CAMERA_TOPIC)
+    await shards.start()
+
+
+async def rebalance():
+    """
+    Reconcile every device after the shard members changed: devices
+    gained are enforced, devices lost are left to their new owner.
+    """
+    log.info(f"Rebalancing rules across {len(shards.members)} instance(s)")
+    await reconcile_all_rules()
+
+
+async def reconcile_targets(targets):
+    """
+    Reconcile the given target devices against all their known rules.
+    """
+    targets = set(targets)
+    rules = [_rules[uuid] for target in targets for uuid in _rules_by_target.get(target, ())]
+
+    tx = FirewallController.transaction()
+    try:
+        await apply_rules(rules, tx, targets)
+    finally:
+        await commit_firewall(tx)
+
+
+async def apply_due_rules(now_ts):
+    """
+    Re-evaluate only the devices targeted by a rule whose scheduled
+    transition is due, together with all their other rules.
+    """
+    due = [_rules[uuid] for uuid in _scheduler.pop_due(now_ts) if uuid in _rules]
+
+    try:
+        await reconcile_targets(_target_of(rule) for rule in due)
+    finally:
+        for rule in due:
+            # A rule past its last window stays known until it expires
+            if rule.uuid in _rules:
+                _scheduler.schedule(rule)
+
+
+async def expire_rules(now=None):
+    """
+    Delete the expired rules in one batch: their devices are reconciled
+    together, in a single firewall transaction, and the rules are deleted
+    from the DHT concurrently through the store's write buffer.
+    In sharded mode only the rules of owned devices are deleted.
+    """
+    now = now or current_time()
+    expired = [
+        _rules[uuid] for uuid in _expiry.expired(now)
+        if uuid in _rules and shards.owns(_rules[uuid].target_uuid)
+    ]
+    if not expired:
+        return
+
+    # Expired rules count as inactive: the devices are reconciled first and
+    # the rules are kept for the next sweep if that fails
+    targets = {_target_of(rule) for rule in expired}
+    await reconcile_targets(targets)
+
+    for rule in expired:
+        _forget(rule.uuid)
+    deletes = [store.delete(PRIVACY_RULE_TOPIC, rule.uuid) for rule in expired]
+    results = await asyncio.gather(*deletes, return_exceptions=True)
+    for rule, result in zip(expired, results):
+        if isinstance(result, Exception):
+            log.error(f"Failed to delete expired privacy rule {rule.uuid}: {result!r}")
+    log.info(f"Deleted {len(expired)} expired privacy rule(s), {len(targets)} device(s) reconciled")
+
+
+async def expire_rules_periodically():
+    """
+    Sweep the expired rules at each local midnight, when rules expire,
+    and as soon as an already expired rule is loaded.
     """
     while True:
+        _expiry_due.clear()
         try:
-            rules_data = await fetch_topics(PRIVACY_RULE_TOPIC)
-
-            for rule_json in rules_data:
-                rule = PrivacyRule(
-                    rule_json["topic_uuid"],
-                    rule_json["value"]["target_topic"],
-                    rule_json["value"]["target_uuid"],
-                    rule_json["value"]
-                )
-
-                target_topic = await fetch_topic(
-                    rule.target_topic,
-                    rule.target_uuid
-                )
-
-                if not target_topic:
-                    log.warning(f"Target topic not found: {rule.target_topic}:{rule.target_uuid}")
-                    continue
-
-                is_camera = target_topic["topic_name"] == "domo_camera"
-                ip_address = target_topic["value"].get("ip_address") if is_camera else None
-                name = target_topic["value"].get("name", "a device")
-
-                # Expired rule
-                if rule.is_expired():
-                    if target_topic["value"].get("privacy", False):
-                        target_topic["value"]["privacy"] = False
-
-                        # Unblock the camera
-                        if is_camera and ip_address:
-                            success = await asyncio.to_thread(FirewallController.unblock_ip, ip_address)
-                            if success:
-                                log.debug(f"Unblocked camera {ip_address} due to expired rule")
-                            else:
-                                log.error(f"Failed to unblock camera {ip_address}")
-
-                        await update_topic(
-                            rule.target_topic,
-                            rule.target_uuid,
-                            target_topic["value"]
-                        )
-                        log.info(f"Privacy rule expired for {name}, device unblocked")
-
-                    await delete_topic(PRIVACY_RULE_TOPIC, rule.uuid)
-                    log.debug(f"Deleted expired privacy rule {rule.uuid}")
-                    continue
-
-                # Active rule
-                if rule.is_active():
-                    if not target_topic["value"].get("privacy", False):
-                        target_topic["value"]["privacy"] = True
-                        target_topic["value"]["privacy_until"] = rule.value["time_end"]
-
-                        # Block the camera
-                        if is_camera and ip_address:
-                            success = await asyncio.to_thread(FirewallController.block_ip, ip_address)
-                            if success:
-                                camera_name = target_topic["value"].get("name", "unknown")
-                                log.debug(f"✓ Blocked camera '{camera_name}' at {ip_address}")
-                            else:
-                                log.error(f"✗ Failed to block camera at {ip_address}")
-
-                        await update_topic(
-                            rule.target_topic,
-                            rule.target_uuid,
-                            target_topic["value"]
-                        )
-                        log.info(f"Privacy rule activated: {name} is now blocked")
-
-                # Inactive rule
-                else:
-                    if target_topic["value"].get("privacy", False):
-                        target_topic["value"]["privacy"] = False
-
-                        # Unblock the camera
-                        if is_camera and ip_address:
-                            success = await asyncio.to_thread(FirewallController.unblock_ip, ip_address)
-                            if success:
-                                log.debug(f"Unblocked camera {ip_address} due to inactive rule")
-                            else:
-                                log.error(f"Failed to unblock camera {ip_address}")
-
-                        await update_topic(
-                            rule.target_topic,
-                            rule.target_uuid,
-                            target_topic["value"]
-                        )
-                        log.info(f"Privacy period ended: {name} is now available again")
-
+            with CYCLE_DURATION.time(kind="expiry"), profiler.cycle("expiry"):
+                await expire_rules()
+            wakeup = next_midnight(current_time()).timestamp()
         except Exception as e:
-            log.error(f"Error in check_rules_periodically: {e}", exc_info=True)
+            log.error(f"Error in expire_rules_periodically: {e}", exc_info=True)
+            wakeup = time.time() + RETRY_INTERVAL
 
-        await asyncio.sleep(60)
+        # Sleep in bounded steps so that a wall clock step does not skip a midnight
+        while not _expiry_due.is_set() and time.time() < wakeup:
+            try:
+                await asyncio.wait_for(_expiry_due.wait(), min(wakeup - time.time(), MAX_EXPIRY_SLEEP))
+            except asyncio.TimeoutError:
+                pass
 
 
-async def listen_rule_deletions(ws_client):
+def request_resync():
     """
-    Listen for WebSocket notifications for rule deletions.
-    When a rule is deleted, unblock the device.
+    The replica missed changes (WebSocket reconnect or queue overflow):
+    invalidate it and run a full scan at once, so that rule changes made
+    meanwhile are applied after the re-sync.
     """
+    global _resync_requested
+    store.invalidate()
+    _resync_requested = True
+    _wakeup.set()
+
+
+async def check_rules_periodically():
+    """
+    Apply the privacy rules to the devices at their exact transition times.
+    Sleeps until the earliest scheduled rule transition, or less if a rule
+    change schedules an earlier one; a full scan of all rules runs every
+    RECONCILE_INTERVAL seconds as a safety net, and at once after
+    request_resync().
+    """
+    global _resync_requested
+    next_full_scan = 0.0
+
     while True:
+        # Wakeup requests made during the cycle are kept for the sleep below
+        _wakeup.clear()
+        now_ts = time.time()
         try:
-            message = await ws_client._message_queue.get()
+            if now_ts >= next_full_scan or _resync_requested:
+                _resync_requested = False
+                with CYCLE_DURATION.time(kind="full"), profiler.cycle("full"):
+                    await reconcile_all_rules()
+                next_full_scan = now_ts + RECONCILE_INTERVAL
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(f"Full rule scan done, {len(_scheduler)} rules scheduled, "
+                              f"{len(active_rules())} active")
+            else:
+                with CYCLE_DURATION.time(kind="due"), profiler.cycle("due"):
+                    await apply_due_rules(now_ts)
 
-            if "Persistent" in message:
-                log.debug(f"Received WS message: {message}")
-                msg = message["Persistent"]
+        except Exception as e:
+            log.error(f"Error in check_rules_periodically: {e}", exc_info=True)
+            # Fall back to a full scan shortly; a failed full scan is not
+            # retried before RETRY_INTERVAL either
+            next_full_scan = time.time() + RETRY_INTERVAL
+
+        wakeup = _scheduler.next_wakeup()
+        if wakeup is None or wakeup > next_full_scan:
+            wakeup = next_full_scan
+        try:
+            await asyncio.wait_for(_wakeup.wait(), max(wakeup - time.time(), MIN_SLEEP))
+        except asyncio.TimeoutError:
+            pass
 
-                if msg["topic_name"] == PRIVACY_RULE_TOPIC and msg.get("deleted", False):
-                    target_topic_name = msg["value"]["target_topic"]
-                    target_uuid = msg["value"]["target_uuid"]
 
-                    target_topic = await fetch_topic(target_topic_name, target_uuid)
+async def check_firewall_drift_periodically():
+    """
+    Periodically compare the in-memory firewall shadow with the kernel chain.
+    """
+    while True:
+        await asyncio.sleep(FIREWALL_DRIFT_INTERVAL)
+        try:
+            if await asyncio.to_thread(FirewallController.check_drift):
+                log.debug("Firewall shadow in sync with the kernel")
+        except Exception as e:
+            log.error(f"Error in check_firewall_drift_periodically: {e}", exc_info=True)
 
-                    if target_topic and target_topic["value"].get("privacy", False):
-                        target_topic["value"]["privacy"] = False
-                        name = target_topic.get("name", "a device")
 
-                        # Unblock the camera
-                        if target_topic_name == "domo_camera":
-                            ip = target_topic["value"].get("ip_address")
-                            if ip:
-                                success = await asyncio.to_thread(FirewallController.unblock_ip, ip)
-                                if success:
-                                    camera_name = target_topic["value"].get("name", "unknown")
-                                    log.debug(f"Unblocked camera '{camera_name}' at {ip} due to rule deletion")
-                                else:
-                                    log.error(f"Failed to unblock camera at {ip}")
+async def handle_rule_update(msg):
+    """
+    Apply a created, edited or deleted rule at once, reconciling only its
+    target device (and the previous one if the target changed).
+    """
+    uuid = msg["topic_uuid"]
+    targets = set()
+
+    previous = _rules.get(uuid)
+    if previous is not None:
+        targets.add(_target_of(previous))
+
+    value = msg.get("value") or {}
+    if msg.get("deleted", False):
+        targets.add((value.get("target_topic"), value.get("target_uuid")))
+        _forget(uuid)
+    else:
+        rule = _build_rule({"topic_uuid": uuid, "value": value})
+        if rule.rejected:
+            _forget(uuid)
+        else:
+            _remember(rule)
+            targets.add(_target_of(rule))
+
+    if targets:
+        await reconcile_targets(targets)
+        log.debug(f"Privacy rule {uuid} {'removed' if msg.get('deleted', False) else 'updated'}, "
+                  f"{len(targets)} device(s) reconciled")
+
+
+async def listen_dht_updates(ws_client):
+    """
+    Listen for WebSocket notifications: keep the topic store in sync and
+    reconcile right away the devices affected by a rule change or by an
+    update of a targeted or blocked device.
+    """
+    while True:
+        try:
+            message = await ws_client._message_queue.get()
 
-                        await update_topic(target_topic_name, target_uuid, target_topic["value"])
-                        log.info(f"Privacy rule removed by user: {name} unblocked")
+            msg = store.apply_message(message)
+            if msg is not None:
+                log.debug(f"Received WS message: {message}")
+                target = (msg["topic_name"], msg["topic_uuid"])
+
+                if msg["topic_name"] == PRIVACY_RULE_TOPIC:
+                    await handle_rule_update(msg)
+                elif msg["topic_name"] == LEASE_TOPIC:
+                    if await shards.refresh_from_store():
+                        await rebalance()
+                elif shards.enabled and msg["topic_name"] == CAMERA_TOPIC and not shards.owns(msg["topic_uuid"]):
+                    tx = FirewallController.transaction()
+                    try:
+                        await mirror_cameras(tx, [msg])
+                    finally:
+                        await commit_firewall(tx)
+                elif target in _rules_by_target or (
+                        msg["topic_name"] == CAMERA_TOPIC and msg["topic_uuid"] in _camera_ips):
+                    # A blocked camera may have changed IP
+                    await reconcile_targets([target])
 
         except Exception as e:
-            log.error(f"Error in listen_rule_deletions: {e}", exc_info=True)
+            log.error(f"Error in listen_dht_updates: {e}", exc_info=True)
             await asyncio.sleep(1)  # Evita loop frenetici in caso di errori continui
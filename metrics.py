@@ -0,0 +1,222 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from aiohttp import web
+
+log = logging.getLogger("Metrics")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CYCLE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()  # firewall commands report from worker threads
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels) -> tuple:
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        """Yield (suffix, label values, extra labels, value) tuples."""
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labels, values, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Without labels the counter is exposed from the start, at zero
+        self._values = {} if self.labels else {(): 0}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield "_total", key, (), value
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down. Instead of being set, it can be read at
+    scrape time from a function returning a number, or a dict mapping
+    label value tuples to numbers.
+    """
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+        self._function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            try:
+                result = self._function()
+            except Exception as e:
+                log.debug(f"Cannot read gauge {self.name}: {e!r}")
+                return
+            items = result.items() if isinstance(result, dict) else [((), result)]
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        for key, value in items:
+            yield "", key, (), value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values = {}  # label values -> [bucket counts, sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self._buckets), 0.0, 0]
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the `with` block, even if it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket in zip(self._buckets, counts):
+                cumulative += bucket
+                yield "_bucket", key, (("le", _format_value(bound)),), cumulative
+            yield "_sum", key, (), total
+            yield "_count", key, (), count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Rule checks
+CYCLE_DURATION = Histogram(
+    "privacy_cycle_duration_seconds", "Duration of the check_rules_periodically cycles.",
+    ["kind"], buckets=CYCLE_BUCKETS
+)
+RULES = Gauge("privacy_rules", "Known privacy rules by state.", ["state"])
+BLOCKED_DEVICES = Gauge("privacy_blocked_devices", "Devices currently blocked by a privacy rule.")
+
+# DHT
+DHT_REQUEST_DURATION = Histogram(
+    "privacy_dht_request_duration_seconds", "Latency of the DHT HTTP requests.", ["method", "endpoint"]
+)
+DHT_REQUEST_ERRORS = Counter(
+    "privacy_dht_request_errors", "Failed DHT HTTP requests, retries included.", ["method", "endpoint"]
+)
+DHT_WRITES = Counter(
+    "privacy_dht_writes", "Buffered DHT writes, by outcome (queued, coalesced, retried, written, failed).",
+    ["outcome"]
+)
+DHT_WRITE_QUEUE_DEPTH = Gauge("privacy_dht_write_queue_depth", "DHT writes not yet acknowledged.")
+
+# Firewall
+FIREWALL_COMMANDS = Counter("privacy_firewall_commands", "Firewall commands run.", ["tool", "result"])
+FIREWALL_COMMAND_DURATION = Histogram(
+    "privacy_firewall_command_duration_seconds", "Duration of the firewall commands.", ["tool"]
+)
+FIREWALL_TIMEOUTS = Counter("privacy_firewall_timeouts", "Firewall commands that timed out.", ["tool"])
+BLOCKED_CAMERAS = Gauge("privacy_blocked_cameras", "Camera IPs blocked in the firewall.")
+
+# Event loop
+EVENT_LOOP_LAG = Histogram(
+    "privacy_event_loop_lag_seconds", "Delay of the event loop in waking up a sleeping task."
+)
+EXECUTOR_QUEUE_DEPTH = Gauge("privacy_executor_queue_depth", "to_thread calls waiting for a worker thread.")
+
+# WebSocket
+WS_QUEUE_DEPTH = Gauge("privacy_ws_queue_depth", "WebSocket messages waiting to be processed.")
+WS_MESSAGES = Counter("privacy_ws_messages", "WebSocket messages received, by outcome.", ["outcome"])
+WS_RECONNECTS = Counter("privacy_ws_reconnects", "WebSocket reconnections to the DHT.")
+
+
+async def start_server(host, port, registry=REGISTRY):
+    """Serve the metrics in Prometheus text format on http://host:port/metrics."""
+    async def handle(request):
+        return web.Response(body=registry.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
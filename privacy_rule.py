@@ -1,45 +1,196 @@
-from datetime import datetime
+import logging
+from datetime import datetime, timedelta, time
 from zoneinfo import ZoneInfo
 
 PRIVACY_RULE_TOPIC = "privacy_rule"
 
 TZ = ZoneInfo("Europe/Rome")
 
-class PrivacyRule:
-    def __init__(self, uuid, target_topic, target_uuid, value):
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+# Fields of a rule value that define its behaviour
+_RULE_FIELDS = ("target_topic", "target_uuid", "days", "time_start", "time_end", "expiration_date")
+
+log = logging.getLogger("PrivacyRule")
+
+
+def _system_clock():
+    return datetime.now(TZ)
+
+
+# Source of the current time, replaced by the schedule simulator
+_clock = _system_clock
+
+
+def current_time():
+    return _clock()
+
+
+def set_clock(clock=None):
+    """Use `clock()` as the current time; None restores the system clock."""
+    global _clock
+    _clock = clock or _system_clock
+
+
+def _parse_minute(value) -> int:
+    t = datetime.strptime(value, "%H:%M").time()
+    return t.hour * 60 + t.minute
+
+
+def _content_hash(value) -> int:
+    if not isinstance(value, dict):
+        return hash(repr(value))
+    return hash(tuple(repr(value.get(field)) for field in _RULE_FIELDS))
+
+
+class CompiledRule:
+    """
+    Parsed form of a privacy rule value: weekday bitmask (bit 0 = Monday),
+    start/end minute of the day and expiration date ordinal.
+    """
+
+    __slots__ = (
+        "uuid", "content_hash", "target_topic", "target_uuid",
+        "days_mask", "start_minute", "end_minute", "expiry_ordinal"
+    )
+
+    rejected = False
+
+    def __init__(self, uuid, content_hash, value):
         self.uuid = uuid
-        self.target_topic = target_topic
-        self.target_uuid = target_uuid
-        self.value = value
+        self.content_hash = content_hash
+        self.target_topic = value["target_topic"]
+        self.target_uuid = value["target_uuid"]
 
-    def _now(self):
-        return datetime.now(TZ)
+        days = value["days"]
+        if not isinstance(days, list):
+            raise TypeError(f"days must be a list, got {type(days).__name__}")
+        self.days_mask = 0
+        for day in days:
+            if day in WEEKDAYS:
+                self.days_mask |= 1 << WEEKDAYS.index(day)
 
-    def is_expired(self) -> bool:
-        exp_date = datetime.strptime(
-            self.value["expiration_date"], "%Y/%m/%d"
-        ).date()
-        return self._now().date() > exp_date
+        self.start_minute = _parse_minute(value["time_start"])
+        self.end_minute = _parse_minute(value["time_end"])
+        self.expiry_ordinal = datetime.strptime(
+            value["expiration_date"], "%Y/%m/%d"
+        ).toordinal()
 
-    def is_active(self) -> bool:
-        now = self._now()
+    def is_expired(self, now) -> bool:
+        return now.toordinal() > self.expiry_ordinal
 
+    def is_active(self, now) -> bool:
         # Check expiration date (<= valid)
-        exp_date = datetime.strptime(
-            self.value["expiration_date"], "%Y/%m/%d"
-        ).date()
-        if now.date() > exp_date:
+        if now.toordinal() > self.expiry_ordinal:
             return False
 
         # Check day of week
-        current_day = now.strftime("%A")  # Monday, Tuesday, ...
-        if current_day not in self.value["days"]:
+        if not self.days_mask & (1 << now.weekday()):
             return False
 
         # Check time window (bounds included)
-        start = datetime.strptime(self.value["time_start"], "%H:%M").time()
-        end = datetime.strptime(self.value["time_end"], "%H:%M").time()
-        current_time = now.time()
+        minute = now.hour * 60 + now.minute
+        if not self.start_minute <= minute <= self.end_minute:
+            return False
+        return minute < self.end_minute or (now.second == 0 and now.microsecond == 0)
+
+    def next_transition(self, now):
+        """
+        Return the first instant after `now` at which the rule switches on
+        or off, or None if it never does again before its expiration.
+        Expiry itself is not a transition: the rule is already off at the
+        midnight it expires, and is deleted by the expiry sweep.
+        """
+        start = time(self.start_minute // 60, self.start_minute % 60)
+        end = time(self.end_minute // 60, self.end_minute % 60)
+
+        candidates = []
+        for offset in range(8):
+            day = now.date() + timedelta(days=offset)
+            if day.toordinal() > self.expiry_ordinal:
+                break
+            if not self.days_mask & (1 << day.weekday()):
+                continue
+
+            # The window includes its closing minute, so it switches off just after it
+            switch_on = datetime.combine(day, start, tzinfo=TZ)
+            switch_off = datetime.combine(day, end, tzinfo=TZ) + timedelta(microseconds=1)
+            candidates.extend(at for at in (switch_on, switch_off) if at > now)
+            if candidates:
+                break
+
+        return min(candidates, default=None)
 
-        return start <= current_time <= end
 
+class RejectedRule:
+    """
+    Placeholder for a malformed rule: never active, never expires and
+    never scheduled, so it is parsed and reported only once.
+    """
+
+    __slots__ = ("uuid", "content_hash", "reason")
+
+    rejected = True
+
+    def __init__(self, uuid, content_hash, reason):
+        self.uuid = uuid
+        self.content_hash = content_hash
+        self.reason = reason
+
+    def is_expired(self, now) -> bool:
+        return False
+
+    def is_active(self, now) -> bool:
+        return False
+
+    def next_transition(self, now):
+        return None
+
+
+# Compiled rules by uuid; an entry is reused while its content hash matches
+_compiled_cache = {}
+
+
+def compile_rule(uuid, value):
+    content_hash = _content_hash(value)
+    cached = _compiled_cache.get(uuid)
+    if cached is not None and cached.content_hash == content_hash:
+        return cached
+
+    try:
+        compiled = CompiledRule(uuid, content_hash, value)
+    except (KeyError, TypeError, ValueError) as e:
+        log.warning(f"Rejected malformed privacy rule {uuid}: {e!r}")
+        compiled = RejectedRule(uuid, content_hash, repr(e))
+
+    _compiled_cache[uuid] = compiled
+    return compiled
+
+
+def forget_rule(uuid):
+    _compiled_cache.pop(uuid, None)
+
+
+class PrivacyRule:
+    def __init__(self, uuid, target_topic, target_uuid, value):
+        self.uuid = uuid
+        self.target_topic = target_topic
+        self.target_uuid = target_uuid
+        self.value = value
+        self.compiled = compile_rule(uuid, value)
+
+    @property
+    def rejected(self) -> bool:
+        return self.compiled.rejected
+
+    def _now(self):
+        return current_time()
+
+    def is_expired(self) -> bool:
+        return self.compiled.is_expired(self._now())
+
+    def is_active(self) -> bool:
+        return self.compiled.is_active(self._now())
+
+    def next_transition(self, now=None):
+        return self.compiled.next_transition(now or self._now())
@@ -0,0 +1,110 @@
+import asyncio
+import cProfile
+import logging
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from metrics import EVENT_LOOP_LAG, EXECUTOR_QUEUE_DEPTH
+from settings import PROFILING, PROFILE_DIR, LOOP_LAG_INTERVAL, SLOW_CALLBACK_THRESHOLD
+
+log = logging.getLogger("Profiler")
+
+
+class LoopProfiler:
+    """
+    Watches the event loop for blocking work. The lag and the executor
+    queue depth are always exported as metrics; in profiling mode, enabled
+    with PROFILING or toggled with SIGUSR1, they are also logged, and the
+    loop runs in debug mode so asyncio logs every callback slower than
+    SLOW_CALLBACK_THRESHOLD with the name of its task.
+    SIGUSR2 requests a cProfile dump of the next rule cycle.
+    """
+
+    def __init__(self, enabled=PROFILING, profile_dir=PROFILE_DIR,
+                 lag_interval=LOOP_LAG_INTERVAL, slow_callback=SLOW_CALLBACK_THRESHOLD):
+        self.enabled = enabled
+        self._profile_dir = profile_dir
+        self._lag_interval = lag_interval
+        self._slow_callback = slow_callback
+        self._loop = None
+        self._executor = None
+        self._capture_requested = False
+
+    def install(self, loop):
+        """Give the loop a default executor we can inspect and hook the signals."""
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(thread_name_prefix="to_thread")
+        loop.set_default_executor(self._executor)
+        loop.slow_callback_duration = self._slow_callback
+        EXECUTOR_QUEUE_DEPTH.set_function(self.executor_queue_depth)
+
+        try:
+            loop.add_signal_handler(signal.SIGUSR1, self.toggle)
+            loop.add_signal_handler(signal.SIGUSR2, self.request_capture)
+        except (NotImplementedError, AttributeError, RuntimeError) as e:
+            log.debug(f"Profiling signals not available: {e!r}")
+        self._apply()
+
+    def _apply(self):
+        if self._loop is not None:
+            self._loop.set_debug(self.enabled)
+        if self.enabled:
+            logging.getLogger("asyncio").setLevel(logging.WARNING)
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self._apply()
+        log.warning(f"Profiling mode {'enabled' if self.enabled else 'disabled'}")
+
+    def request_capture(self):
+        self._capture_requested = True
+        log.warning("cProfile capture requested for the next rule cycle")
+
+    def executor_queue_depth(self) -> int:
+        if self._executor is None:
+            return 0
+        return self._executor._work_queue.qsize()
+
+    async def monitor(self):
+        """Measure how late the loop wakes this task up."""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self._lag_interval)
+            lag = max(loop.time() - started - self._lag_interval, 0.0)
+            EVENT_LOOP_LAG.observe(lag)
+
+            if not self.enabled:
+                continue
+            if lag > self._slow_callback:
+                log.warning(f"Event loop lag: {lag * 1000:.0f} ms")
+            depth = self.executor_queue_depth()
+            if depth:
+                log.warning(f"{depth} to_thread call(s) waiting for a worker thread")
+
+    @contextmanager
+    def cycle(self, name):
+        """Profile the enclosed cycle with cProfile if a capture was requested."""
+        if not self._capture_requested:
+            yield
+            return
+
+        self._capture_requested = False
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            path = os.path.join(self._profile_dir, f"privacy-{name}-cycle-{datetime.now():%Y%m%d-%H%M%S}.prof")
+            try:
+                profile.dump_stats(path)
+                log.warning(f"Profile of the {name} cycle written to {path}")
+            except OSError as e:
+                log.error(f"Cannot write profile to {path}: {e}")
+
+
+# Shared profiler, installed by main.py
+profiler = LoopProfiler()
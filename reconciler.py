@@ -0,0 +1,27 @@
+def desired_state(rules, now):
+    """
+    Combine all the rules of a device into its desired privacy state.
+    Returns (privacy, privacy_until): the device is private while any of
+    its rules is active, until the latest end time among them.
+    """
+    active = [rule for rule in rules if rule.compiled.is_active(now)]
+    if not active:
+        return False, None
+
+    latest = max(active, key=lambda rule: rule.compiled.end_minute)
+    return True, latest.value["time_end"]
+
+
+def diff_device(value, rules, now) -> dict:
+    """
+    Return the fields of a device value that differ from the desired state
+    of its rules; an empty dict means nothing has to be written.
+    """
+    privacy, privacy_until = desired_state(rules, now)
+
+    changes = {}
+    if value.get("privacy", False) != privacy:
+        changes["privacy"] = privacy
+    if privacy and value.get("privacy_until") != privacy_until:
+        changes["privacy_until"] = privacy_until
+    return changes
@@ -0,0 +1,121 @@
+import bisect
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger("RuleIndex")
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+# Segments whose active set is kept; lookups mostly hit the current one
+SEGMENT_CACHE_SIZE = 8
+
+_EMPTY = frozenset()
+
+
+def minute_of_week(dt) -> int:
+    return dt.weekday() * MINUTES_PER_DAY + dt.hour * 60 + dt.minute
+
+
+class WeeklyRuleIndex:
+    """
+    Index of the privacy rule windows over the minutes of a week.
+    Each rule keeps its windows as minute-of-week intervals, and a sorted
+    list of window boundaries splits the week into segments over which
+    the active set does not change. The active set of a segment is
+    computed on first lookup and kept in a small cache, which adding or
+    removing a rule updates in place for the segments its windows cover.
+    Windows are indexed as [time_start, time_end): the closing minute
+    itself is left out. Expiration is not tracked here.
+    """
+
+    def __init__(self):
+        self._windows = {}  # rule uuid -> list of (first, last + 1) minutes of week
+        self._boundary_refs = {}  # minute of week -> number of windows bounded there
+        self._boundaries = []  # sorted keys of _boundary_refs
+        self._segments = OrderedDict()  # segment start minute -> active uuids, least recent first
+
+    def __len__(self):
+        return len(self._windows)
+
+    def __contains__(self, uuid):
+        return uuid in self._windows
+
+    def add(self, compiled):
+        """Index a CompiledRule, replacing any previous entry for its uuid."""
+        self.remove(compiled.uuid)
+
+        windows = []
+        if compiled.start_minute < compiled.end_minute:
+            for day in range(7):
+                if compiled.days_mask & (1 << day):
+                    base = day * MINUTES_PER_DAY
+                    windows.append((base + compiled.start_minute, base + compiled.end_minute))
+
+        for first, stop in windows:
+            # A new boundary splits a segment: the part before it keeps
+            # its start and its active set, the part after is not cached
+            self._add_boundary(first)
+            self._add_boundary(stop)
+            for start, active in self._segments.items():
+                if first <= start < stop:
+                    active.add(compiled.uuid)
+
+        self._windows[compiled.uuid] = windows
+
+    def remove(self, uuid):
+        windows = self._windows.pop(uuid, None)
+        if windows is None:
+            return
+
+        for first, stop in windows:
+            for start, active in self._segments.items():
+                if first <= start < stop:
+                    active.discard(uuid)
+            # A boundary left unused merges its segment into the previous
+            # one, whose active set is the same from now on
+            for minute in (first, stop):
+                if self._remove_boundary(minute):
+                    self._segments.pop(minute, None)
+
+    def _add_boundary(self, minute):
+        refs = self._boundary_refs.get(minute, 0)
+        if refs == 0:
+            bisect.insort(self._boundaries, minute)
+        self._boundary_refs[minute] = refs + 1
+
+    def _remove_boundary(self, minute) -> bool:
+        """Returns True if the boundary is no longer used."""
+        refs = self._boundary_refs[minute] - 1
+        if refs == 0:
+            del self._boundary_refs[minute]
+            del self._boundaries[bisect.bisect_left(self._boundaries, minute)]
+            return True
+        self._boundary_refs[minute] = refs
+        return False
+
+    def active_at(self, dt):
+        """
+        Return the uuids of the rules whose window covers `dt`.
+        The returned set is owned by the index and must not be modified.
+        """
+        minute = minute_of_week(dt)
+        i = bisect.bisect_right(self._boundaries, minute)
+        if i == 0 or i == len(self._boundaries):
+            # Windows do not wrap around the week: nothing is active
+            # before the first boundary or from the last one
+            return _EMPTY
+
+        start = self._boundaries[i - 1]
+        active = self._segments.get(start)
+        if active is None:
+            active = {
+                uuid for uuid, windows in self._windows.items()
+                if any(first <= minute < stop for first, stop in windows)
+            }
+            self._segments[start] = active
+            if len(self._segments) > SEGMENT_CACHE_SIZE:
+                self._segments.popitem(last=False)
+        else:
+            self._segments.move_to_end(start)
+        return active
@@ -0,0 +1,67 @@
+import heapq
+import logging
+
+log = logging.getLogger("RuleScheduler")
+
+
+class RuleScheduler:
+    """
+    Priority queue of upcoming privacy rule transitions.
+    Each rule has at most one pending entry: the next instant at which it
+    switches on or off. Superseded entries are left in the heap and
+    skipped lazily when popped.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._pending = {}  # rule uuid -> timestamp of its next transition
+
+    def __len__(self):
+        return len(self._pending)
+
+    def schedule(self, rule, now=None) -> bool:
+        """
+        (Re)schedule the next transition of a rule.
+        Returns False if the rule has no future transition.
+        """
+        when = rule.next_transition(now)
+        if when is None:
+            self._pending.pop(rule.uuid, None)
+            return False
+
+        ts = when.timestamp()
+        if self._pending.get(rule.uuid) != ts:
+            self._pending[rule.uuid] = ts
+            heapq.heappush(self._heap, (ts, rule.uuid))
+            log.debug(f"Rule {rule.uuid} next transition at {when.isoformat()}")
+        return True
+
+    def discard(self, uuid):
+        self._pending.pop(uuid, None)
+
+    def clear(self):
+        self._heap.clear()
+        self._pending.clear()
+
+    def _drop_stale(self):
+        while self._heap:
+            ts, uuid = self._heap[0]
+            if self._pending.get(uuid) == ts:
+                return
+            heapq.heappop(self._heap)
+
+    def next_wakeup(self):
+        """Timestamp of the earliest pending transition, or None."""
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now_ts) -> list:
+        """Remove and return the uuids of the rules due at `now_ts`."""
+        due = []
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now_ts:
+            _, uuid = heapq.heappop(self._heap)
+            del self._pending[uuid]
+            due.append(uuid)
+            self._drop_stale()
+        return due
@@ -1,6 +1,67 @@
 """Handle configuration of environment variables"""
 
 import os
+import socket
 
 DHT_HOST = os.getenv("DHT_HOST", "localhost")
 DHT_PORT = int(os.getenv("DHT_PORT", 3000))
+
+# HTTP connection pool towards the DHT
+DHT_POOL_LIMIT = int(os.getenv("DHT_POOL_LIMIT", 8))
+DHT_TIMEOUT = float(os.getenv("DHT_TIMEOUT", 10))
+DHT_CONNECT_TIMEOUT = float(os.getenv("DHT_CONNECT_TIMEOUT", 3))
+DHT_RETRIES = int(os.getenv("DHT_RETRIES", 2))
+DHT_RETRY_BACKOFF = float(os.getenv("DHT_RETRY_BACKOFF", 0.5))
+
+# Full rule reconciliation interval (seconds), on top of the transition scheduler
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", 600))
+
+# Interval (seconds) between comparisons of the firewall shadow with the kernel
+FIREWALL_DRIFT_INTERVAL = float(os.getenv("FIREWALL_DRIFT_INTERVAL", 300))
+
+# Firewall backend: "iptables" (one DROP rule per camera) or "ipset" (one rule matching a set)
+FIREWALL_BACKEND = os.getenv("FIREWALL_BACKEND", "iptables")
+
+# Target devices processed concurrently per cycle, and cycle deadline (seconds)
+RULE_CONCURRENCY = int(os.getenv("RULE_CONCURRENCY", 16))
+CYCLE_DEADLINE = float(os.getenv("CYCLE_DEADLINE", 30))
+
+# Write-behind DHT writes: concurrent writes, retries and first retry delay (seconds, doubled each time)
+WRITE_CONCURRENCY = int(os.getenv("WRITE_CONCURRENCY", 16))
+WRITE_RETRIES = int(os.getenv("WRITE_RETRIES", 5))
+WRITE_RETRY_BACKOFF = float(os.getenv("WRITE_RETRY_BACKOFF", 1))
+
+# SQLite enforcement journal used for warm restarts (empty to disable)
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "privacy_journal.db")
+
+# WebSocket ingest: queue bound, overflow policy ("drop_oldest" or "block")
+# and window (seconds) in which updates to the same topic are merged
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", 1000))
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "drop_oldest")
+WS_COALESCE_WINDOW = float(os.getenv("WS_COALESCE_WINDOW", 0.05))
+
+# Prometheus metrics endpoint, served on http://METRICS_HOST:METRICS_PORT/metrics (port 0 to disable)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+
+# Sharded mode: instances split the target devices by consistent hashing of
+# their uuid, and announce themselves with lease topics renewed every
+# SHARD_LEASE_RENEW seconds and expiring after SHARD_LEASE_TTL seconds
+SHARDING = os.getenv("SHARDING", "").lower() in ("1", "true", "yes")
+INSTANCE_ID = os.getenv("INSTANCE_ID") or socket.gethostname()
+SHARD_LEASE_TTL = float(os.getenv("SHARD_LEASE_TTL", 30))
+SHARD_LEASE_RENEW = float(os.getenv("SHARD_LEASE_RENEW", 10))
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", 64))
+
+# Gateway this instance runs on; cameras whose CAMERA_GATEWAY_FIELD names
+# another gateway are left to the firewall of that gateway's instance
+GATEWAY_ID = os.getenv("GATEWAY_ID") or INSTANCE_ID
+CAMERA_GATEWAY_FIELD = os.getenv("CAMERA_GATEWAY_FIELD", "gateway_id")
+
+# Profiling mode (also toggled with SIGUSR1): logs event loop lag, slow callbacks
+# over SLOW_CALLBACK_THRESHOLD seconds and to_thread calls waiting for a thread.
+# SIGUSR2 writes a cProfile dump of the next rule cycle to PROFILE_DIR
+PROFILING = os.getenv("PROFILING", "").lower() in ("1", "true", "yes")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp")
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 1))
+SLOW_CALLBACK_THRESHOLD = float(os.getenv("SLOW_CALLBACK_THRESHOLD", 0.1))
@@ -0,0 +1,147 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+from topic_store import store
+from settings import (
+    SHARDING, INSTANCE_ID, GATEWAY_ID, CAMERA_GATEWAY_FIELD,
+    SHARD_LEASE_TTL, SHARD_LEASE_RENEW, SHARD_VNODES
+)
+
+log = logging.getLogger("Sharding")
+
+LEASE_TOPIC = "privacy_manager_lease"
+
+
+def _hash(key) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring of instance ids, each placed at `vnodes` points.
+    When an instance joins or leaves, only the keys of the ring arcs it
+    gains or loses change owner.
+    """
+
+    def __init__(self, members=(), vnodes=SHARD_VNODES):
+        self.members = frozenset(members)
+        points = sorted((_hash(f"{member}#{i}"), member) for member in self.members for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [member for _, member in points]
+
+    def owner(self, key):
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[i]
+
+
+class ShardCoordinator:
+    """
+    Decides which target devices this instance enforces in sharded mode.
+    Each instance keeps a lease topic in the DHT, renewed every
+    `renew_interval` seconds and valid for `ttl` seconds; the live leases
+    form the hash ring. When an instance stops renewing its lease, the
+    others drop it from the ring and take over its devices.
+    Camera firewalls are enforced by the instance of the camera's gateway,
+    whichever instance owns the camera's rules.
+    When sharding is disabled this instance owns every device.
+    """
+
+    def __init__(self, instance_id=INSTANCE_ID, gateway_id=GATEWAY_ID, enabled=SHARDING,
+                 ttl=SHARD_LEASE_TTL, renew_interval=SHARD_LEASE_RENEW, vnodes=SHARD_VNODES):
+        self.instance_id = instance_id
+        self.gateway_id = gateway_id
+        self.enabled = enabled
+        self._ttl = ttl
+        self._renew_interval = renew_interval
+        self._vnodes = vnodes
+        self._ring = HashRing([instance_id], vnodes)
+
+    @property
+    def members(self) -> frozenset:
+        return self._ring.members
+
+    def owns(self, target_uuid) -> bool:
+        """True if this instance evaluates the rules of the target device."""
+        return not self.enabled or self._ring.owner(target_uuid) == self.instance_id
+
+    def enforces_firewall(self, camera_uuid, value) -> bool:
+        """
+        True if this instance manages the firewall entry of the camera:
+        the camera is on this gateway or, if it does not name a gateway,
+        this instance owns it.
+        """
+        if not self.enabled:
+            return True
+        gateway = value.get(CAMERA_GATEWAY_FIELD)
+        if gateway is None:
+            return self.owns(camera_uuid)
+        return gateway == self.gateway_id
+
+    def refresh(self, leases, now=None) -> bool:
+        """Rebuild the ring from the lease topics; returns True if the members changed."""
+        now = time.time() if now is None else now
+        members = {self.instance_id}
+        for lease in leases:
+            if (lease.get("value") or {}).get("expires_at", 0) > now:
+                members.add(lease["topic_uuid"])
+
+        if members == self._ring.members:
+            return False
+
+        joined = sorted(members - self._ring.members)
+        left = sorted(self._ring.members - members)
+        self._ring = HashRing(members, self._vnodes)
+        log.info(f"Shard members changed ({len(members)} instances)"
+                 + (f", joined: {', '.join(joined)}" if joined else "")
+                 + (f", left: {', '.join(left)}" if left else ""))
+        return True
+
+    async def renew(self):
+        now = time.time()
+        await store.update(LEASE_TOPIC, self.instance_id, {
+            "gateway_id": self.gateway_id,
+            "renewed_at": now,
+            "expires_at": now + self._ttl
+        })
+
+    async def refresh_from_store(self) -> bool:
+        return self.refresh(await store.topics(LEASE_TOPIC))
+
+    async def start(self):
+        """Take a lease and read the other members before enforcing anything."""
+        store.watch(LEASE_TOPIC)
+        await self.renew()
+        await self.refresh_from_store()
+        log.info(f"Sharding enabled: instance {self.instance_id} on gateway {self.gateway_id}, "
+                 f"{len(self.members)} instance(s)")
+
+    async def run(self, on_change, on_renew=None):
+        """
+        Renew the lease, then call `on_change()` if the members changed,
+        or `on_renew()` otherwise.
+        """
+        while True:
+            await asyncio.sleep(self._renew_interval)
+            try:
+                await self.renew()
+                if await self.refresh_from_store():
+                    await on_change()
+                elif on_renew is not None:
+                    await on_renew()
+            except Exception as e:
+                log.error(f"Error renewing shard lease: {e}", exc_info=True)
+
+    async def release(self):
+        """Give up the lease so the other instances take over at once."""
+        try:
+            await store.delete(LEASE_TOPIC, self.instance_id)
+        except Exception as e:
+            log.error(f"Failed to release shard lease: {e}")
+
+
+# Shared coordinator, started by main.py in sharded mode
+shards = ShardCoordinator()
@@ -0,0 +1,255 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import time as timer
+from collections import defaultdict
+from datetime import datetime, date, time, timedelta
+from functools import lru_cache
+from privacy_rule import TZ, PRIVACY_RULE_TOPIC, PrivacyRule, compile_rule, set_clock
+
+log = logging.getLogger("Simulator")
+
+SECONDS_PER_DAY = 24 * 60 * 60
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+class SimulatedClock:
+    """Clock for set_clock() that only moves when told to."""
+
+    def __init__(self, start):
+        self.current = start
+
+    def __call__(self):
+        return self.current
+
+    def set(self, current):
+        self.current = current
+
+
+def _utcoffset(instant) -> int:
+    return int(datetime.fromtimestamp(instant, TZ).utcoffset().total_seconds())
+
+
+@lru_cache(maxsize=None)
+def day_spans(day) -> tuple:
+    """
+    Split a local day into spans of constant UTC offset, as tuples
+    (first, stop, midnight) of epoch seconds: an instant in [first, stop)
+    reads `instant - midnight` seconds after 00:00 on the wall clock.
+    DST days have two spans: on the spring one the skipped hour is never
+    read, on the autumn one the repeated hour is read twice.
+    """
+    naive_midnight = (day.toordinal() - _EPOCH_ORDINAL) * SECONDS_PER_DAY
+    first = int(datetime.combine(day, time(0), tzinfo=TZ).timestamp())
+    stop = int(datetime.combine(day + timedelta(days=1), time(0), tzinfo=TZ).timestamp())
+
+    before, after = _utcoffset(first), _utcoffset(stop - 1)
+    if before == after:
+        return ((first, stop, naive_midnight - before),)
+
+    # Find the offset change to the second
+    lo, hi = first, stop - 1
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if _utcoffset(mid) == before:
+            lo = mid
+        else:
+            hi = mid
+    return ((first, hi, naive_midnight - before), (hi, stop, naive_midnight - after))
+
+
+def rule_intervals(compiled, first_day, last_day):
+    """
+    Yield the (start, stop) epoch second intervals during which the rule
+    is active between two local days, both included. Windows are taken as
+    [time_start, time_end), like the weekly index.
+    """
+    if compiled.start_minute >= compiled.end_minute:
+        return
+    last_day = min(last_day, date.fromordinal(compiled.expiry_ordinal))
+    window_start, window_end = compiled.start_minute * 60, compiled.end_minute * 60
+
+    for weekday in range(7):
+        if not compiled.days_mask & (1 << weekday):
+            continue
+        day = first_day + timedelta(days=(weekday - first_day.weekday()) % 7)
+        while day <= last_day:
+            for first, stop, midnight in day_spans(day):
+                lo = max(first, midnight + window_start)
+                hi = min(stop, midnight + window_end)
+                if lo < hi:
+                    yield lo, hi
+            day += timedelta(days=7)
+
+
+def simulate(rules_data, start, days):
+    """
+    Compute the block/unblock transitions of every device targeted by the
+    rules over `days` days from `start`, jumping from window to window.
+    Returns ({(target_topic, target_uuid): [(epoch seconds, blocked)]},
+    list of rejected rule uuids). A device blocked at `start` gets a
+    block transition at `start`.
+    """
+    start_ts = start.timestamp()
+    end = start + timedelta(days=days)
+    end_ts = end.timestamp()
+    first_day, last_day = start.date(), end.date()
+
+    intervals = defaultdict(list)
+    rejected = []
+    for rule_json in rules_data:
+        compiled = compile_rule(rule_json["topic_uuid"], rule_json.get("value"))
+        if compiled.rejected:
+            rejected.append(compiled.uuid)
+            continue
+        target = (compiled.target_topic, compiled.target_uuid)
+        intervals[target].extend(rule_intervals(compiled, first_day, last_day))
+
+    timelines = {}
+    for target, spans in intervals.items():
+        spans.sort()
+        transitions = []
+        current_start = current_stop = None
+        for lo, hi in spans:
+            if hi <= start_ts or lo >= end_ts:
+                continue
+            if current_stop is not None and lo <= current_stop:
+                current_stop = max(current_stop, hi)
+                continue
+            if current_stop is not None:
+                transitions.append((max(current_start, start_ts), True))
+                if current_stop < end_ts:
+                    transitions.append((current_stop, False))
+            current_start, current_stop = lo, hi
+        if current_stop is not None:
+            transitions.append((max(current_start, start_ts), True))
+            if current_stop < end_ts:
+                transitions.append((current_stop, False))
+        timelines[target] = transitions
+
+    return timelines, rejected
+
+
+def verify(rules_data, timelines, samples, seed=0):
+    """
+    Check sampled transitions against PrivacyRule.is_active() evaluated
+    through a simulated clock, one second before and after each of them.
+    Returns the list of mismatches.
+    """
+    rules_by_target = defaultdict(list)
+    for rule_json in rules_data:
+        value = rule_json.get("value") or {}
+        rule = PrivacyRule(rule_json["topic_uuid"], value.get("target_topic"), value.get("target_uuid"), value)
+        if not rule.rejected:
+            rules_by_target[(rule.target_topic, rule.target_uuid)].append(rule)
+
+    transitions = [(target, at, blocked) for target, timeline in timelines.items() for at, blocked in timeline]
+    rng = random.Random(seed)
+    if len(transitions) > samples:
+        transitions = rng.sample(transitions, samples)
+
+    clock = SimulatedClock(None)
+    set_clock(clock)
+    mismatches = []
+    try:
+        for target, at, blocked in transitions:
+            for offset, expected in ((-1, not blocked), (1, blocked)):
+                clock.set(datetime.fromtimestamp(at + offset, TZ))
+                if any(rule.is_active() for rule in rules_by_target[target]) != expected:
+                    mismatches.append((target, at + offset, expected))
+    finally:
+        set_clock(None)
+    return mismatches
+
+
+def _format(at) -> str:
+    return datetime.fromtimestamp(at, TZ).isoformat()
+
+
+async def _fetch_rules():
+    from dht_client import client
+
+    try:
+        return await client.fetch_topics(PRIVACY_RULE_TOPIC)
+    finally:
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fast-forward the privacy rules and print the block/unblock timeline of each device."
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("rules", nargs="?", help="JSON file with a list of privacy_rule topics")
+    source.add_argument("--from-dht", action="store_true", help="read the rules from the DHT")
+    parser.add_argument("--start", help="local start time, ISO format (default: now)")
+    parser.add_argument("--days", type=float, default=7, help="simulated days (default: 7)")
+    parser.add_argument("--format", choices=("text", "json", "summary"), default="text")
+    parser.add_argument("--output", help="write the timeline to a file instead of stdout")
+    parser.add_argument("--verify", type=int, default=0, metavar="N",
+                        help="check N sampled transitions against PrivacyRule.is_active()")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(name)s]: %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S", stream=sys.stderr)
+
+    if args.from_dht:
+        rules_data = asyncio.run(_fetch_rules())
+    else:
+        with open(args.rules) as f:
+            rules_data = json.load(f)
+
+    start = datetime.now(TZ)
+    if args.start:
+        start = datetime.fromisoformat(args.start)
+        start = start.replace(tzinfo=TZ) if start.tzinfo is None else start.astimezone(TZ)
+
+    started = timer.perf_counter()
+    timelines, rejected = simulate(rules_data, start, args.days)
+    elapsed = timer.perf_counter() - started
+
+    count = sum(len(timeline) for timeline in timelines.values())
+    log.info(f"Simulated {len(rules_data)} rules on {len(timelines)} devices over {args.days:g} days "
+             f"from {start.isoformat()}: {count} transitions in {elapsed:.2f}s")
+    if rejected:
+        log.warning(f"{len(rejected)} malformed rules ignored: {', '.join(rejected[:10])}")
+
+    if args.verify:
+        mismatches = verify(rules_data, timelines, args.verify)
+        for target, at, expected in mismatches[:20]:
+            log.error(f"{target[0]}:{target[1]} at {_format(at)}: simulated "
+                      f"{'blocked' if expected else 'unblocked'}, rules say otherwise")
+        log.info(f"Verified {args.verify} transitions: {len(mismatches)} mismatch(es)")
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        if args.format == "json":
+            json.dump({
+                "start": start.isoformat(),
+                "days": args.days,
+                "rejected": rejected,
+                "devices": {
+                    f"{topic}:{uuid}": [{"at": _format(at), "action": "block" if blocked else "unblock"}
+                                        for at, blocked in timeline]
+                    for (topic, uuid), timeline in sorted(timelines.items())
+                }
+            }, out, indent=2)
+            out.write("\n")
+        elif args.format == "text":
+            for (topic, uuid), timeline in sorted(timelines.items()):
+                for at, blocked in timeline:
+                    out.write(f"{_format(at)} {'block' if blocked else 'unblock':<7} {topic}:{uuid}\n")
+        else:
+            for (topic, uuid), timeline in sorted(timelines.items()):
+                blocks = sum(1 for _, blocked in timeline if blocked)
+                out.write(f"{topic}:{uuid} {blocks} block(s), {len(timeline) - blocks} unblock(s)\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+from dht_client import fetch_all_topics, fetch_topic, update_topic, delete_topic
+from privacy_rule import PRIVACY_RULE_TOPIC
+from write_buffer import WriteBuffer
+from metrics import DHT_WRITE_QUEUE_DEPTH
+
+log = logging.getLogger("TopicStore")
+
+
+def _copy(topic):
+    # Callers modify the returned value in place before writing it back
+    return {
+        "topic_name": topic["topic_name"],
+        "topic_uuid": topic["topic_uuid"],
+        "value": dict(topic.get("value") or {})
+    }
+
+
+class TopicStore:
+    """
+    In-memory replica of the DHT topics.
+    Seeded from /get_all, kept up to date from the WebSocket `Persistent`
+    messages and re-synced after a reconnect, so steady-state reads do not
+    hit the DHT. A topic missing from the replica is fetched on demand.
+    Only the watched topic names are kept current from the WebSocket; the
+    others are filtered out before decoding (see accepts()).
+    Writes go to the replica at once and to the DHT through a write-behind
+    buffer; until the DHT acknowledges them they take precedence over the
+    snapshots and WebSocket messages. A message that is neither one of
+    them nor their echo is a concurrent change from elsewhere: once the
+    write is acknowledged, the replica is reported stale (see on_stale).
+    """
+
+    def __init__(self, watched=()):
+        self._topics = {}  # topic_name -> {topic_uuid -> topic}
+        self._synced = False
+        self._sync_lock = asyncio.Lock()
+        self._pending = None  # messages received while a sync is in flight
+        self._watched = set(watched)
+        self._filtered = set()  # unwatched names whose messages were dropped since the last sync
+        self._conflicts = set()  # keys changed elsewhere while our write was pending
+        # Called when the replica is known to be stale; defaults to invalidate()
+        self.on_stale = None
+        # A write given up after its retries leaves the replica ahead of the DHT
+        self._writes = WriteBuffer(update_topic, delete_topic, on_failure=lambda key: self._stale())
+
+    @property
+    def synced(self) -> bool:
+        return self._synced
+
+    def invalidate(self):
+        """Mark the replica as stale, e.g. after a WebSocket reconnect."""
+        if self._synced:
+            log.debug("Topic store invalidated, will re-sync on next read")
+        self._synced = False
+
+    def _stale(self):
+        (self.on_stale or self.invalidate)()
+
+    def watch(self, name):
+        """
+        Keep the topics called `name` current from the WebSocket.
+        If messages for it were filtered out, the replica is re-synced.
+        """
+        if name in self._watched:
+            return
+        self._watched.add(name)
+        if name in self._filtered:
+            log.debug(f"Started watching {name}, will re-sync on next read")
+            self._synced = False
+
+    def accepts(self, name) -> bool:
+        """WebSocket filter: True if messages for the topic name are needed."""
+        if name in self._watched:
+            return True
+        self._filtered.add(name)
+        return False
+
+    async def sync(self):
+        """Re-read every topic from the DHT, even if the replica is current."""
+        async with self._sync_lock:
+            await self._sync()
+
+    async def _sync(self):
+        self._pending = []
+        self._filtered.clear()
+        try:
+            topics = await fetch_all_topics()
+        except Exception:
+            self._pending = None
+            raise
+
+        replica = {}
+        for topic in topics:
+            replica.setdefault(topic["topic_name"], {})[topic["topic_uuid"]] = topic
+        self._topics = replica
+
+        # Replay the changes that may be newer than the snapshot
+        pending, self._pending = self._pending, None
+        for message in pending:
+            self.apply_message(message)
+        for (name, uuid), write in self._writes.unacknowledged():
+            self._apply_write(name, uuid, write)
+
+        self._synced = True
+        log.debug(f"Topic store synced with {len(topics)} topics")
+
+    async def ensure_synced(self):
+        if self._synced:
+            return
+        async with self._sync_lock:
+            # Readers queued behind a sync in progress use its result
+            if not self._synced:
+                await self._sync()
+
+    def apply_message(self, message):
+        """
+        Apply a WebSocket message to the replica.
+        Returns the `Persistent` payload, or None for other messages.
+        """
+        msg = message.get("Persistent")
+        if msg is None:
+            return None
+
+        if self._pending is not None:
+            self._pending.append(message)
+
+        key = (msg["topic_name"], msg["topic_uuid"])
+        writes = self._writes.writes(key)
+        if writes:
+            # Our own write in progress is newer, unless the message is a
+            # change made elsewhere meanwhile: the DHT is then re-read once
+            # the write is acknowledged
+            value = None if msg.get("deleted", False) else msg.get("value")
+            ours = [write.value if write.op == "update" else None for write in writes]
+            if value not in ours and key not in self._conflicts:
+                self._conflicts.add(key)
+                writes[-1].futures[-1].add_done_callback(lambda future: self._resolve_conflict(key))
+            return msg
+        if msg.get("deleted", False):
+            self.remove(msg["topic_name"], msg["topic_uuid"])
+        else:
+            self.put(msg["topic_name"], msg["topic_uuid"], msg.get("value"))
+        return msg
+
+    def _resolve_conflict(self, key):
+        self._conflicts.discard(key)
+        log.debug(f"{key[0]}:{key[1]} changed elsewhere during our write, replica is stale")
+        self._stale()
+
+    def put(self, name, uuid, value):
+        self._topics.setdefault(name, {})[uuid] = {
+            "topic_name": name,
+            "topic_uuid": uuid,
+            "value": value
+        }
+
+    def remove(self, name, uuid):
+        self._topics.get(name, {}).pop(uuid, None)
+
+    async def all_topics(self) -> list:
+        await self.ensure_synced()
+        return [_copy(topic) for topics in self._topics.values() for topic in topics.values()]
+
+    async def topics(self, name) -> list:
+        await self.ensure_synced()
+        return [_copy(topic) for topic in self._topics.get(name, {}).values()]
+
+    async def topic(self, name, uuid):
+        await self.ensure_synced()
+        topic = self._topics.get(name, {}).get(uuid)
+        if topic is None:
+            # Cache miss: ask the DHT
+            topic = await fetch_topic(name, uuid)
+            if not topic:
+                return None
+            log.debug(f"Cache miss for {name}:{uuid}, fetched from DHT")
+            self.put(name, uuid, topic.get("value"))
+        return _copy(topic)
+
+    def _apply_write(self, name, uuid, write):
+        if write.op == "update":
+            self.put(name, uuid, dict(write.value))
+        else:
+            self.remove(name, uuid)
+
+    def update(self, name, uuid, value) -> asyncio.Future:
+        """
+        Write a topic to the replica now and to the DHT in the background.
+        Await the returned future to wait for the DHT acknowledgement.
+        """
+        value = dict(value)
+        self.put(name, uuid, value)
+        return self._writes.update(name, uuid, value)
+
+    def delete(self, name, uuid) -> asyncio.Future:
+        """Delete a topic from the replica now and from the DHT in the background."""
+        self.remove(name, uuid)
+        return self._writes.delete(name, uuid)
+
+    async def flush(self):
+        """Wait for the buffered DHT writes to be acknowledged."""
+        await self._writes.flush()
+
+    async def close(self):
+        """Flush the buffered DHT writes, for a limited time, and stop the writers."""
+        await self._writes.close()
+
+
+# Shared replica, kept in sync by the WebSocket listener
+store = TopicStore(watched=(PRIVACY_RULE_TOPIC,))
+DHT_WRITE_QUEUE_DEPTH.set_function(lambda: len(store._writes))
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from metrics import DHT_WRITES
+from settings import WRITE_CONCURRENCY, WRITE_RETRIES, WRITE_RETRY_BACKOFF
+
+log = logging.getLogger("WriteBuffer")
+
+MAX_RETRY_DELAY = 60
+CLOSE_TIMEOUT = 10
+
+
+def _consume(future):
+    # Failures are logged by the buffer; callers that never await a
+    # future should not trigger "exception was never retrieved"
+    if not future.cancelled():
+        future.exception()
+
+
+class PendingWrite:
+    __slots__ = ("op", "value", "futures")
+
+    def __init__(self, op, value, future):
+        self.op = op  # "update" or "delete"
+        self.value = value
+        self.futures = [future]
+
+
+class WriteBuffer:
+    """
+    Write-behind queue of DHT topic writes keyed by (topic_name, topic_uuid).
+    A write replaces the one still pending for the same key, so bursts of
+    writes to a device are sent once with the latest value. Writes are
+    sent by `concurrency` workers, one at a time per key, and retried
+    with exponential backoff. Each call returns a future resolved when the
+    write (or the one that replaced it) is acknowledged by the DHT.
+    """
+
+    def __init__(self, update, delete, concurrency=WRITE_CONCURRENCY, retries=WRITE_RETRIES,
+                 backoff=WRITE_RETRY_BACKOFF, on_failure=None):
+        self._update = update
+        self._delete = delete
+        self._concurrency = concurrency
+        self._retries = retries
+        self._backoff = backoff
+        # Called with the key of a write abandoned after the last retry
+        self._on_failure = on_failure
+        self._pending = OrderedDict()  # key -> PendingWrite, not started yet
+        self._in_flight = {}  # key -> PendingWrite being sent
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._workers = []
+
+    def __len__(self):
+        return len(self._pending) + len(self._in_flight)
+
+    def update(self, name, uuid, value) -> asyncio.Future:
+        return self._submit((name, uuid), "update", value)
+
+    def delete(self, name, uuid) -> asyncio.Future:
+        return self._submit((name, uuid), "delete", None)
+
+    def _submit(self, key, op, value):
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume)
+
+        write = self._pending.get(key)
+        if write is None:
+            self._pending[key] = PendingWrite(op, value, future)
+            DHT_WRITES.inc(outcome="queued")
+        else:
+            write.op, write.value = op, value
+            write.futures.append(future)
+            DHT_WRITES.inc(outcome="coalesced")
+
+        self._start_workers()
+        self._idle.clear()
+        self._wakeup.set()
+        return future
+
+    def latest(self, key):
+        """Return the newest write not yet acknowledged for `key`, or None."""
+        return self._pending.get(key) or self._in_flight.get(key)
+
+    def writes(self, key) -> list:
+        """Return the writes not yet acknowledged for `key`, oldest first."""
+        return [write for write in (self._in_flight.get(key), self._pending.get(key)) if write is not None]
+
+    def unacknowledged(self):
+        """Yield (key, write) for every write not yet acknowledged, oldest first."""
+        yield from self._in_flight.items()
+        yield from self._pending.items()
+
+    def _start_workers(self):
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._worker(), name=f"dht-writer-{i}")
+                for i in range(self._concurrency)
+            ]
+
+    def _next(self):
+        # A key already being written waits for that write to finish
+        for key in self._pending:
+            if key not in self._in_flight:
+                return key, self._pending.pop(key)
+        return None
+
+    async def _worker(self):
+        while True:
+            item = self._next()
+            if item is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            key, write = item
+            self._in_flight[key] = write
+            try:
+                await self._send(key, write)
+            finally:
+                del self._in_flight[key]
+                if key in self._pending:
+                    self._wakeup.set()
+                if not self._pending and not self._in_flight:
+                    self._idle.set()
+
+    async def _send(self, key, write):
+        attempt = 0
+        while True:
+            try:
+                if write.op == "update":
+                    await self._update(key[0], key[1], write.value)
+                else:
+                    await self._delete(key[0], key[1])
+            except Exception as e:
+                newer = self._pending.get(key)
+                if newer is not None:
+                    # Superseded: the callers get the outcome of the newer write
+                    newer.futures[:0] = write.futures
+                    return
+
+                if attempt >= self._retries:
+                    DHT_WRITES.inc(outcome="failed")
+                    log.error(f"Giving up {write.op} of {key[0]}:{key[1]} after {attempt + 1} attempts: {e!r}")
+                    for future in write.futures:
+                        if not future.done():
+                            future.set_exception(e)
+                    if self._on_failure:
+                        self._on_failure(key)
+                    return
+
+                delay = min(self._backoff * (2 ** attempt), MAX_RETRY_DELAY)
+                attempt += 1
+                DHT_WRITES.inc(outcome="retried")
+                log.warning(f"Failed to {write.op} {key[0]}:{key[1]} ({e!r}), "
+                            f"retry {attempt}/{self._retries} in {delay}s")
+                await asyncio.sleep(delay)
+            else:
+                DHT_WRITES.inc(outcome="written")
+                for future in write.futures:
+                    if not future.done():
+                        future.set_result(None)
+                return
+
+    async def flush(self):
+        """Wait until every write submitted so far is acknowledged or abandoned."""
+        while self._pending or self._in_flight:
+            self._idle.clear()
+            await self._idle.wait()
+
+    async def close(self, timeout=CLOSE_TIMEOUT):
+        """Flush for at most `timeout` seconds, then stop the workers."""
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            log.error(f"{len(self)} DHT write(s) not flushed before shutdown")
+
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+        for _, write in list(self.unacknowledged()):
+            for future in write.futures:
+                future.cancel()
+        self._pending.clear()
+        self._in_flight.clear()
@@ -1,28 +1,145 @@
 import asyncio
 import json
 import logging
+import re
+from collections import OrderedDict
 import websockets
+from metrics import WS_MESSAGES, WS_RECONNECTS
 from settings import DHT_HOST, DHT_PORT
 
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
 log = logging.getLogger("WebSocketClient")
 
+# Name of the topic in a `Persistent` message, read without decoding the rest
+_TOPIC_NAME = re.compile(r'"Persistent"\s*:\s*\{.*?"topic_name"\s*:\s*"([^"\\]*)"', re.S)
+
+OVERFLOW_POLICIES = ("drop_oldest", "block")
+
+
+def peek_topic_name(raw):
+    """Return the topic_name of a raw `Persistent` message, or None."""
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8", "replace")
+    match = _TOPIC_NAME.search(raw)
+    return match.group(1) if match else None
+
+
+class CoalescingQueue:
+    """
+    Bounded queue of WebSocket messages keyed by topic.
+    Each message is held for `window` seconds; a newer message for the same
+    key replaces the waiting one in place, so a burst of updates to a topic
+    is delivered once, with its latest value.
+    When the queue is full, "drop_oldest" discards the oldest message and
+    calls `on_overflow` (the replica has missed a change), while "block"
+    makes the WebSocket reader wait for the consumer.
+    """
+
+    def __init__(self, maxsize=0, window=0.0, overflow="drop_oldest", on_overflow=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self._maxsize = maxsize
+        self._window = window
+        self._overflow = overflow
+        self._on_overflow = on_overflow
+        self._entries = OrderedDict()  # key -> [ready_at, message]
+        self._added = asyncio.Event()
+        self._removed = asyncio.Event()
+
+    def qsize(self) -> int:
+        return len(self._entries)
+
+    def full(self) -> bool:
+        return 0 < self._maxsize <= len(self._entries)
+
+    async def put(self, key, message):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[1] = message
+            WS_MESSAGES.inc(outcome="coalesced")
+            return
+
+        while self.full():
+            if self._overflow == "block":
+                self._removed.clear()
+                await self._removed.wait()
+                continue
+            self._entries.popitem(last=False)
+            WS_MESSAGES.inc(outcome="dropped")
+            log.warning("WebSocket queue full, dropped the oldest message")
+            if self._on_overflow:
+                self._on_overflow()
+
+        loop = asyncio.get_running_loop()
+        self._entries[key] = [loop.time() + self._window, message]
+        WS_MESSAGES.inc(outcome="queued")
+        self._added.set()
+
+    async def get(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._entries:
+                self._added.clear()
+                await self._added.wait()
+                continue
+
+            # Entries are kept in arrival order, so the head is ready first
+            key, (ready_at, message) = next(iter(self._entries.items()))
+            delay = ready_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            del self._entries[key]
+            self._removed.set()
+            return message
+
+
 class WSClient:
-    def __init__(self, message_queue):
+    def __init__(self, message_queue, on_connect=None, accept=None):
         self._host = DHT_HOST
         self._port = DHT_PORT
         self._ws = None
         self._message_queue = message_queue
+        # Called on every (re)connection: messages may have been missed
+        self._on_connect = on_connect
+        # Called with the topic_name of each message; rejected ones are not decoded
+        self._accept = accept
+
+    async def _ingest(self, raw):
+        topic_name = peek_topic_name(raw)
+        if topic_name is None:
+            return
+        if self._accept and not self._accept(topic_name):
+            WS_MESSAGES.inc(outcome="filtered")
+            return
+
+        data = _loads(raw)
+        msg = data.get("Persistent")
+        if not isinstance(msg, dict):
+            return
+        await self._message_queue.put((topic_name, msg.get("topic_uuid")), data)
 
     async def run(self):
         backoff = 1
+        connected = False
         while True:
             try:
                 async with websockets.connect(f"ws://{self._host}:{self._port}/ws") as self._ws:
                     log.info("Connected to Smartotum DHT WebSocket")
+                    if connected:
+                        WS_RECONNECTS.inc()
+                    connected = True
                     backoff = 1
+                    if self._on_connect:
+                        self._on_connect()
                     async for message in self._ws:
-                        data = json.loads(message)
-                        await self._message_queue.put(data)
+                        await self._ingest(message)
             except asyncio.CancelledError:
                 log.debug("WebSocket listener cancelled")
                 raise